@@ -0,0 +1,176 @@
+import json
+import time
+
+# derived tables, refreshed whenever the data they summarize changes
+METRIC_TABLES = ['ticket_metrics', 'agent_metrics', 'tier_metrics']
+
+RESOLUTION_HOURS_SQL = (
+    'CASE WHEN t.resolved_at IS NOT NULL '
+    'THEN (julianday(t.resolved_at) - julianday(t.created_at)) * 24 END'
+)
+
+TICKET_METRICS_SQL = f"""
+INSERT OR REPLACE INTO ticket_metrics (
+    ticket_id, customer_id, customer_tier, status, priority, created_at, created_month,
+    resolved_at, resolution_hours, interaction_count, total_handle_minutes,
+    first_interaction_at, last_interaction_at
+)
+SELECT t.id, t.customer_id, c.tier, t.status, t.priority, t.created_at, substr(t.created_at, 1, 7),
+       t.resolved_at, {RESOLUTION_HOURS_SQL}, COUNT(i.id), COALESCE(SUM(i.duration_minutes), 0),
+       MIN(i.timestamp), MAX(i.timestamp)
+FROM support_tickets t
+LEFT JOIN customers c ON c.id = t.customer_id
+LEFT JOIN interactions i ON i.ticket_id = t.id
+WHERE {{predicate}}
+GROUP BY t.id
+"""
+
+AGENT_METRICS_SQL = """
+INSERT INTO agent_metrics (
+    agent_name, interaction_count, tickets_handled, total_handle_minutes, avg_handle_minutes,
+    phone_count, chat_count, email_count, last_interaction_at
+)
+SELECT agent_name, COUNT(*), COUNT(DISTINCT ticket_id), COALESCE(SUM(duration_minutes), 0),
+       AVG(duration_minutes), SUM(interaction_type = 'phone'), SUM(interaction_type = 'chat'),
+       SUM(interaction_type = 'email'), MAX(timestamp)
+FROM interactions
+WHERE agent_name IS NOT NULL AND {predicate}
+GROUP BY agent_name
+"""
+
+TIER_METRICS_SQL = f"""
+INSERT INTO tier_metrics (
+    tier, customer_count, ticket_count, open_ticket_count, resolved_ticket_count,
+    tickets_per_customer, avg_resolution_hours
+)
+SELECT COALESCE(c.tier, 'unknown'), COUNT(DISTINCT c.id), COUNT(t.id),
+       COALESCE(SUM(t.status IN ('open', 'in_progress')), 0),
+       COALESCE(SUM(t.status IN ('resolved', 'closed')), 0),
+       CAST(COUNT(t.id) AS REAL) / COUNT(DISTINCT c.id), AVG({RESOLUTION_HOURS_SQL})
+FROM customers c
+LEFT JOIN support_tickets t ON t.customer_id = c.id
+WHERE {{predicate}}
+GROUP BY COALESCE(c.tier, 'unknown')
+"""
+
+# key lists are bound as one json array so batches of any size need a single parameter
+IN_KEYS = 'IN (SELECT value FROM json_each(?))'
+
+def new_changes():
+    """empty set of keys whose metrics need recomputing"""
+    return {'tickets': set(), 'customers': set(), 'agents': set(), 'tiers': set()}
+
+def _keys(values):
+    """encode a key set as a json array parameter"""
+    return json.dumps(sorted(values, key=str))
+
+def collect_changes(cursor, table_name, rows, changes):
+    """record the metric keys touched by upserting rows into table_name, before the write"""
+    ids = [row['id'] for row in rows if row.get('id') is not None]
+    
+    if table_name == 'customers':
+        # a tier change moves the customer's tickets between tiers
+        changes['customers'].update(ids)
+        cursor.execute(f'SELECT id, tier FROM customers WHERE id {IN_KEYS}', [_keys(ids)])
+        existing = dict(cursor.fetchall())
+        changes['tiers'].update(tier or 'unknown' for tier in existing.values())
+        # new customers sent without a tier land in the 'unknown' tier
+        changes['tiers'].update(
+            (row.get('tier') or 'unknown') for row in rows
+            if 'tier' in row or row.get('id') not in existing
+        )
+        
+    elif table_name == 'support_tickets':
+        changes['tickets'].update(ids)
+        customer_ids = {row['customer_id'] for row in rows if row.get('customer_id') is not None}
+        cursor.execute(f'SELECT customer_id FROM support_tickets WHERE id {IN_KEYS}', [_keys(ids)])
+        customer_ids.update(row[0] for row in cursor.fetchall())
+        cursor.execute(f'SELECT DISTINCT tier FROM customers WHERE id {IN_KEYS}', [_keys(customer_ids)])
+        changes['tiers'].update(row[0] or 'unknown' for row in cursor.fetchall())
+        
+    elif table_name == 'interactions':
+        # both the previous and the new ticket/agent of a moved interaction change
+        changes['tickets'].update(row['ticket_id'] for row in rows if row.get('ticket_id') is not None)
+        changes['agents'].update(row['agent_name'] for row in rows if row.get('agent_name') is not None)
+        cursor.execute(f'SELECT ticket_id, agent_name FROM interactions WHERE id {IN_KEYS}', [_keys(ids)])
+        for ticket_id, agent_name in cursor.fetchall():
+            changes['tickets'].add(ticket_id)
+            if agent_name is not None:
+                changes['agents'].add(agent_name)
+
+def last_id(cursor, table_name):
+    """highest id in table_name, taken before a write that inserts rows without an id"""
+    cursor.execute(f'SELECT MAX(id) FROM {table_name}')
+    return cursor.fetchone()[0] or 0
+
+def collect_inserted(cursor, table_name, after_id, changes):
+    """record the metric keys of rows inserted without an id, after the write
+    
+    sqlite numbers those rows above the previous highest id; only new tickets need this, the
+    other tables' keys (ticket, agent, tier) come from the rows themselves
+    """
+    if table_name == 'support_tickets':
+        cursor.execute('SELECT id FROM support_tickets WHERE id > ?', [after_id])
+        changes['tickets'].update(row[0] for row in cursor.fetchall())
+
+def refresh_ticket_metrics(cursor, changes):
+    """recompute ticket rows for changed tickets and customers; returns the tables written"""
+    written = []
+    if changes['tickets']:
+        cursor.execute(TICKET_METRICS_SQL.format(predicate=f't.id {IN_KEYS}'), [_keys(changes['tickets'])])
+        written.append('ticket_metrics')
+    if changes['customers']:
+        cursor.execute(TICKET_METRICS_SQL.format(predicate=f't.customer_id {IN_KEYS}'), [_keys(changes['customers'])])
+        written.append('ticket_metrics')
+    changes['tickets'].clear()
+    changes['customers'].clear()
+    return sorted(set(written))
+
+def refresh_rollups(cursor, changes):
+    """recompute agent and tier rows for changed keys; returns the tables written"""
+    written = []
+    if changes['agents']:
+        agents = _keys(changes['agents'])
+        cursor.execute(f'DELETE FROM agent_metrics WHERE agent_name {IN_KEYS}', [agents])
+        cursor.execute(AGENT_METRICS_SQL.format(predicate=f'agent_name {IN_KEYS}'), [agents])
+        written.append('agent_metrics')
+    if changes['tiers']:
+        tiers = _keys(changes['tiers'])
+        cursor.execute(f'DELETE FROM tier_metrics WHERE tier {IN_KEYS}', [tiers])
+        cursor.execute(TIER_METRICS_SQL.format(predicate=f"COALESCE(c.tier, 'unknown') {IN_KEYS}"), [tiers])
+        written.append('tier_metrics')
+    changes['agents'].clear()
+    changes['tiers'].clear()
+    return written
+
+def rebuild_metrics(cursor):
+    """recompute every metric table from scratch"""
+    for table in METRIC_TABLES:
+        cursor.execute(f'DELETE FROM {table}')
+    cursor.execute(TICKET_METRICS_SQL.format(predicate='1'))
+    cursor.execute(AGENT_METRICS_SQL.format(predicate='1'))
+    cursor.execute(TIER_METRICS_SQL.format(predicate='1'))
+    return list(METRIC_TABLES)
+
+def metrics_missing(cursor):
+    """true when tickets exist but the metric tables were never built"""
+    cursor.execute('SELECT EXISTS (SELECT 1 FROM support_tickets) AND NOT EXISTS (SELECT 1 FROM ticket_metrics)')
+    return bool(cursor.fetchone()[0])
+
+if __name__ == '__main__':
+    # python analytics.py -- rebuild all metric tables
+    from app import create_app
+    from ingest import mark_tables_changed
+    from models import db
+    app = create_app()
+    
+    with app.app_context():
+        start_time = time.perf_counter()
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            mark_tables_changed(cursor, rebuild_metrics(cursor))
+            connection.commit()
+        finally:
+            connection.close()
+        print(f'Rebuilt {", ".join(METRIC_TABLES)} in {time.perf_counter() - start_time:.2f}s')
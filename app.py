@@ -1,18 +1,69 @@
+import gzip
+import hmac
+import importlib
 import os
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, render_template, request, jsonify, session
+from sqlalchemy.engine import make_url
 from config import Config
-from models import db, QueryLog, Feedback
-from query_engine import QueryEngine
+from models import db, QueryLog, Feedback, QuerySummary
+from ingest import INGEST_MODELS, ingest_stream, mark_tables_changed
+from analytics import metrics_missing, rebuild_metrics
+from shared_cache import get_shared_cache
+import schema_cache
+from llm_scheduler import LLMBusyError
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used when brotli is not installed
+    brotli = None
 
 def create_app():
     """application factory pattern"""
     app = Flask(__name__)
     app.config.from_object(Config)
     
+    # generated queries, ingestion, the summary tables and log retention all use sqlite sql
+    backend = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+    if backend != 'sqlite':
+        raise RuntimeError(f'DATABASE_URL must be a SQLite database (got {backend}).')
+    
     # initialize database
     db.init_app(app)
     
+    # create any missing tables and indexes without touching existing data
+    with app.app_context():
+        # in wal mode readers and writers never block each other, so long reads (snapshot
+        # refreshes, row counts) cannot make ingestion or query logging time out; the mode
+        # is stored in the database file
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('PRAGMA journal_mode=WAL')
+        
+        # reflecting every table and index is the slowest part of startup, so it is
+        # skipped while neither the models nor the database schema changed since last time
+        cache_path = app.config['SCHEMA_CACHE_PATH'] or os.path.join(app.instance_path, 'schema_cache.json')
+        database = db.engine.url.database
+        if not schema_cache.is_current(cache_path, database, schema_cache.schema_state(db.engine, db.metadata)):
+            db.create_all()
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(db.engine, checkfirst=True)
+            
+            # databases created before the summary tables existed get them built once
+            connection = db.engine.raw_connection()
+            try:
+                cursor = connection.cursor()
+                if metrics_missing(cursor):
+                    mark_tables_changed(cursor, rebuild_metrics(cursor))
+                    connection.commit()
+            finally:
+                connection.close()
+            
+            schema_cache.remember(cache_path, database, schema_cache.schema_state(db.engine, db.metadata))
+    
     # initialize query engine
     if not app.config['OPENAI_API_KEY']:
         print("WARNING: OPENAI_API_KEY not set. Please add it to your .env file.")
@@ -21,6 +72,56 @@ def create_app():
 
 app = create_app()
 
+# the query engine pulls in the openai sdk, the slowest import of the app; lazy workers
+# load it with their first query instead, eager ones (and a preloading master) up front
+if not app.config['LAZY_INIT']:
+    importlib.import_module('query_engine')
+
+def get_query_engine():
+    """build a query engine, importing it on first use"""
+    from query_engine import QueryEngine
+    return QueryEngine(app.config['OPENAI_API_KEY'])
+
+# background summaries, keyed by log id while they are running
+summary_executor = ThreadPoolExecutor(max_workers=app.config['SUMMARY_WORKERS'])
+summary_jobs = {}
+summary_jobs_lock = threading.Lock()
+
+SUMMARY_MODES = ('inline', 'deferred', 'background')
+
+# how long a summary job may hold its cross-worker claim, and how long /summary waits on another worker
+SUMMARY_JOB_TTL = 120
+SUMMARY_WAIT_SECONDS = 60
+
+# rows: list of per-row dicts; columnar: column names once plus a list of value arrays
+RESULT_FORMATS = ('rows', 'columnar')
+
+@app.after_request
+def compress_response(response):
+    """compress large json responses with brotli or gzip when the client accepts it"""
+    if (response.direct_passthrough
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype != 'application/json'):
+        return response
+    
+    body = response.get_data()
+    if len(body) < app.config['COMPRESS_MIN_BYTES']:
+        return response
+    
+    accepted = request.headers.get('Accept-Encoding', '').lower()
+    if brotli is not None and 'br' in accepted:
+        response.set_data(brotli.compress(body, quality=min(app.config['COMPRESS_LEVEL'], 11)))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accepted:
+        response.set_data(gzip.compress(body, compresslevel=app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    return response
+
 def get_session_id():
     """get or create session id for tracking user queries"""
     if 'session_id' not in session:
@@ -32,6 +133,25 @@ def index():
     """main query interface"""
     return render_template('index.html')
 
+def _summarize_in_background(log_id, user_question, sql, results, columns):
+    """generate and cache a summary outside the request that produced the results"""
+    with app.app_context():
+        try:
+            engine = get_query_engine()
+            return engine.get_summary(log_id, user_question, sql, results, columns)
+        finally:
+            get_shared_cache().delete(f'summary-job:{log_id}')
+
+def start_summary_job(log_id, user_question, sql, results, columns):
+    """queue a background summary unless a worker is already generating it"""
+    # the claim is shared, so only one worker process calls the llm for a given log
+    if not get_shared_cache().add(f'summary-job:{log_id}', os.getpid(), ttl=SUMMARY_JOB_TTL):
+        return
+    with summary_jobs_lock:
+        job = summary_executor.submit(_summarize_in_background, log_id, user_question, sql, results, columns)
+        summary_jobs[log_id] = job
+    job.add_done_callback(lambda _: summary_jobs.pop(log_id, None))
+
 @app.route('/query', methods=['POST'])
 def query():
     """process natural language query"""
@@ -49,13 +169,125 @@ def query():
                 'error': 'OpenAI API key not configured. Please add OPENAI_API_KEY to your .env file.'
             }), 500
         
+        summary_mode = data.get('summary_mode', app.config['SUMMARY_MODE'])
+        if summary_mode not in SUMMARY_MODES:
+            return jsonify({'success': False, 'error': 'Invalid summary_mode'}), 400
+        
+        result_format = data.get('format', 'rows')
+        if result_format not in RESULT_FORMATS:
+            return jsonify({'success': False, 'error': 'Invalid format'}), 400
+        
+        # true or false overrides the guess of whether the question refines the previous answer
+        follow_up = data.get('follow_up')
+        if follow_up not in (None, True, False):
+            return jsonify({'success': False, 'error': 'Invalid follow_up'}), 400
+        
+        # counting every matching row re-runs the query, so truncated results skip it unless asked
+        count_total = data.get('count_total', False)
+        if count_total not in (True, False):
+            return jsonify({'success': False, 'error': 'Invalid count_total'}), 400
+        
         # process query
-        engine = QueryEngine(app.config['OPENAI_API_KEY'])
+        engine = get_query_engine()
         session_id = get_session_id()
         
-        result = engine.process_query(user_question, session_id)
+        result = engine.process_query(
+            user_question, session_id, defer_summary=summary_mode != 'inline', follow_up=follow_up,
+            count_total=count_total
+        )
+        
+        # keep the rows where any worker can summarize them without re-running the query
+        if result['success'] and summary_mode != 'inline':
+            get_shared_cache().set(f"summary-results:{result['log_id']}", {
+                'question': user_question,
+                'sql': result['sql'],
+                'results': result['results'],
+                'columns': result['columns']
+            }, ttl=app.config['SUMMARY_RESULTS_TTL'])
+        
+        # start the summary now so it is usually ready by the time the ui asks
+        if result['success'] and summary_mode == 'background':
+            start_summary_job(
+                result['log_id'], user_question, result['sql'], result['results'], result['columns']
+            )
+        
+        # column names are sent once instead of being repeated on every row
+        if result['success'] and result_format == 'columnar':
+            columns = result['columns']
+            result['rows'] = [[row[col] for col in columns] for row in result.pop('results')]
+        result['format'] = result_format
         
         return jsonify(result)
+    
+    except LLMBusyError as e:
+        # answer at once instead of holding the request until the rate limit frees up
+        response = jsonify({'success': False, 'busy': True, 'retry_after': e.retry_after, 'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/summary/<int:log_id>')
+def summary(log_id):
+    """return the summary for a logged query, generating and caching it on first request"""
+    try:
+        # wait for a background summary already running in this process
+        with summary_jobs_lock:
+            job = summary_jobs.get(log_id)
+        if job:
+            return jsonify({'success': True, 'log_id': log_id, 'summary': job.result()})
+        
+        cached = QuerySummary.query.filter_by(query_log_id=log_id).first()
+        if cached:
+            return jsonify({'success': True, 'log_id': log_id, 'summary': cached.summary})
+        
+        # another worker is generating it: wait for the summary row it writes
+        cache = get_shared_cache()
+        deadline = time.monotonic() + SUMMARY_WAIT_SECONDS
+        while cache.get(f'summary-job:{log_id}') is not None and time.monotonic() < deadline:
+            time.sleep(0.25)
+            cached = QuerySummary.query.filter_by(query_log_id=log_id).first()
+            if cached:
+                return jsonify({'success': True, 'log_id': log_id, 'summary': cached.summary})
+        
+        log_entry = QueryLog.query.get(log_id)
+        if not log_entry or not log_entry.success or not log_entry.generated_sql:
+            return jsonify({'success': False, 'error': 'No successful query found for this log'}), 404
+        
+        if not app.config['OPENAI_API_KEY']:
+            return jsonify({
+                'success': False,
+                'error': 'OpenAI API key not configured. Please add OPENAI_API_KEY to your .env file.'
+            }), 500
+        
+        # use the rows stashed by /query, and only re-run the logged sql once they have expired
+        engine = get_query_engine()
+        pending = cache.get(f'summary-results:{log_id}')
+        if pending:
+            results, columns = pending['results'], pending['columns']
+        else:
+            results, columns, _ = engine.run_sql(log_entry.generated_sql)
+        summary_text = engine.get_summary(
+            log_id, log_entry.user_question, log_entry.generated_sql, results, columns
+        )
+        
+        return jsonify({'success': True, 'log_id': log_id, 'summary': summary_text})
+    
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/count/<int:log_id>')
+def count(log_id):
+    """count every row a logged query matches, for results truncated at the row limit"""
+    try:
+        log_entry = QueryLog.query.get(log_id)
+        if not log_entry or not log_entry.success or not log_entry.generated_sql:
+            return jsonify({'success': False, 'error': 'No successful query found for this log'}), 404
+        
+        from query_engine import count_matching_rows
+        total_count, total_capped = count_matching_rows(log_entry.generated_sql)
+        return jsonify({'success': True, 'log_id': log_id, 'total_count': total_count, 'total_capped': total_capped})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
@@ -131,6 +363,33 @@ def submit_feedback():
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/ingest/<table>', methods=['POST'])
+def ingest(table):
+    """bulk upsert an ndjson stream of records from the helpdesk sync"""
+    try:
+        # ingestion writes data, so it stays disabled until a shared token is configured
+        token = app.config['INGEST_TOKEN']
+        if not token:
+            return jsonify({'success': False, 'error': 'Ingestion is disabled. Set INGEST_TOKEN to enable it.'}), 403
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return jsonify({'success': False, 'error': 'Unauthorized'}), 401
+        
+        if table not in INGEST_MODELS:
+            return jsonify({'success': False, 'error': f'Unknown table: {table}'}), 404
+        
+        # stream the body line by line instead of buffering the whole payload
+        stream = request.stream
+        if request.headers.get('Content-Encoding') == 'gzip':
+            stream = gzip.GzipFile(fileobj=stream, mode='rb')
+        
+        batch_size = request.args.get('batch_size', type=int) or app.config['INGEST_BATCH_SIZE']
+        result = ingest_stream(table, stream, batch_size)
+        
+        return jsonify(result)
+        
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/schema')
 def schema():
     """display database schema information"""
@@ -179,6 +438,50 @@ def schema():
                 {'name': 'created_at', 'type': 'DateTime', 'description': 'When note was created'},
                 {'name': 'tags', 'type': 'String', 'description': 'Comma-separated tags'}
             ]
+        },
+        'ticket_metrics': {
+            'description': 'Precomputed per-ticket metrics (maintained automatically)',
+            'columns': [
+                {'name': 'ticket_id', 'type': 'Integer', 'description': 'Reference to ticket'},
+                {'name': 'customer_id', 'type': 'Integer', 'description': 'Reference to customer'},
+                {'name': 'customer_tier', 'type': 'String', 'description': "Tier of the ticket's customer"},
+                {'name': 'status', 'type': 'String', 'description': 'Ticket status'},
+                {'name': 'priority', 'type': 'String', 'description': 'Ticket priority'},
+                {'name': 'created_at', 'type': 'DateTime', 'description': 'When ticket was created'},
+                {'name': 'created_month', 'type': 'String', 'description': 'Creation month (YYYY-MM)'},
+                {'name': 'resolved_at', 'type': 'DateTime', 'description': 'When ticket was resolved'},
+                {'name': 'resolution_hours', 'type': 'Float', 'description': 'Hours from creation to resolution'},
+                {'name': 'interaction_count', 'type': 'Integer', 'description': 'Interactions on the ticket'},
+                {'name': 'total_handle_minutes', 'type': 'Integer', 'description': 'Sum of interaction durations'},
+                {'name': 'first_interaction_at', 'type': 'DateTime', 'description': 'First interaction time'},
+                {'name': 'last_interaction_at', 'type': 'DateTime', 'description': 'Most recent interaction time'}
+            ]
+        },
+        'agent_metrics': {
+            'description': 'Precomputed per-agent workload (maintained automatically)',
+            'columns': [
+                {'name': 'agent_name', 'type': 'String', 'description': 'Name of support agent'},
+                {'name': 'interaction_count', 'type': 'Integer', 'description': 'Interactions handled'},
+                {'name': 'tickets_handled', 'type': 'Integer', 'description': 'Distinct tickets handled'},
+                {'name': 'total_handle_minutes', 'type': 'Integer', 'description': 'Sum of interaction durations'},
+                {'name': 'avg_handle_minutes', 'type': 'Float', 'description': 'Average timed interaction duration'},
+                {'name': 'phone_count', 'type': 'Integer', 'description': 'Phone interactions'},
+                {'name': 'chat_count', 'type': 'Integer', 'description': 'Chat interactions'},
+                {'name': 'email_count', 'type': 'Integer', 'description': 'Email interactions'},
+                {'name': 'last_interaction_at', 'type': 'DateTime', 'description': 'Most recent interaction'}
+            ]
+        },
+        'tier_metrics': {
+            'description': 'Precomputed ticket totals per customer tier (maintained automatically)',
+            'columns': [
+                {'name': 'tier', 'type': 'String', 'description': 'Account tier'},
+                {'name': 'customer_count', 'type': 'Integer', 'description': 'Customers in the tier'},
+                {'name': 'ticket_count', 'type': 'Integer', 'description': 'Tickets from the tier'},
+                {'name': 'open_ticket_count', 'type': 'Integer', 'description': 'Open or in-progress tickets'},
+                {'name': 'resolved_ticket_count', 'type': 'Integer', 'description': 'Resolved or closed tickets'},
+                {'name': 'tickets_per_customer', 'type': 'Float', 'description': 'Average tickets per customer'},
+                {'name': 'avg_resolution_hours', 'type': 'Float', 'description': 'Average resolution time'}
+            ]
         }
     }
     
@@ -0,0 +1,312 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# representative generated sql: aggregations over tickets/interactions plus point lookups
+ENGINE_WORKLOAD = [
+    ('tickets by priority and status',
+     "SELECT priority, status, COUNT(*) AS ticket_count FROM support_tickets "
+     "GROUP BY priority, status ORDER BY priority, status"),
+    ('monthly ticket volume by priority',
+     "SELECT substr(created_at, 1, 7) AS month, priority, COUNT(*) AS ticket_count FROM support_tickets "
+     "GROUP BY month, priority ORDER BY month, priority"),
+    ('handle time per agent',
+     "SELECT agent_name, COUNT(*) AS interactions, SUM(duration_minutes) AS total_minutes, "
+     "AVG(duration_minutes) AS avg_minutes FROM interactions GROUP BY agent_name ORDER BY agent_name"),
+    ('interactions per ticket (top 20)',
+     "SELECT ticket_id, COUNT(*) AS interaction_count FROM interactions "
+     "GROUP BY ticket_id ORDER BY interaction_count DESC, ticket_id LIMIT 20"),
+    ('tickets per customer tier',
+     "SELECT c.tier, COUNT(t.id) AS tickets, SUM(t.status = 'open') AS open_tickets "
+     "FROM customers c JOIN support_tickets t ON t.customer_id = c.id GROUP BY c.tier ORDER BY c.tier"),
+    ('interaction mix by channel and priority',
+     "SELECT t.priority, i.interaction_type, COUNT(*) AS interactions, AVG(i.duration_minutes) AS avg_minutes "
+     "FROM interactions i JOIN support_tickets t ON t.id = i.ticket_id "
+     "GROUP BY t.priority, i.interaction_type ORDER BY t.priority, i.interaction_type"),
+    ('avg resolution hours by priority per month',
+     "SELECT strftime('%Y-%m', created_at) AS month, priority, "
+     "AVG((julianday(resolved_at) - julianday(created_at)) * 24) AS avg_resolution_hours "
+     "FROM support_tickets WHERE resolved_at IS NOT NULL GROUP BY month, priority ORDER BY month, priority"),
+    ('weekly tickets per priority (int division)',
+     "SELECT priority, COUNT(*) / 7 AS per_week FROM support_tickets GROUP BY priority ORDER BY priority"),
+    ('avg handle minutes per agent (integer cast)',
+     "SELECT agent_name, CAST(AVG(duration_minutes) AS INTEGER) AS minutes FROM interactions "
+     "GROUP BY agent_name ORDER BY agent_name"),
+    ('top customers by tickets (tied counts)',
+     "SELECT customer_id, COUNT(*) AS c FROM support_tickets GROUP BY customer_id ORDER BY c DESC LIMIT 5"),
+    ('tickets by priority (unaliased count)',
+     "SELECT priority, COUNT(*) FROM support_tickets GROUP BY priority ORDER BY priority"),
+    ('handle time per channel (unaliased)',
+     "SELECT interaction_type, SUM(duration_minutes), AVG(duration_minutes), MAX(timestamp) FROM interactions "
+     "GROUP BY interaction_type ORDER BY interaction_type"),
+    ('rounded ticket id sum per tier (round)',
+     "SELECT c.tier, ROUND(SUM(t.id)) AS id_sum FROM customers c JOIN support_tickets t ON t.customer_id = c.id "
+     "GROUP BY c.tier ORDER BY c.tier"),
+    ('ticket point lookup',
+     "SELECT * FROM support_tickets WHERE id = 4242"),
+    ('customer ticket history',
+     "SELECT id, subject, status, created_at FROM support_tickets WHERE customer_id = 77 ORDER BY created_at DESC")
+]
+
+def _synthetic_records(tickets, seed=7):
+    """yield (table, ndjson lines) for a synthetic dataset of the given ticket volume"""
+    rng = random.Random(seed)
+    customers = max(tickets // 20, 10)
+    start = datetime(2024, 1, 1)
+    
+    yield 'customers', (
+        json.dumps({
+            'id': i, 'name': f'Customer {i}', 'email': f'customer{i}@example.com',
+            'company': f'Company {i % 500}', 'tier': rng.choice(['free', 'pro', 'enterprise']),
+            'signup_date': (start - timedelta(days=rng.randint(0, 720))).isoformat()
+        }) for i in range(1, customers + 1)
+    )
+    
+    def tickets_stream():
+        for i in range(1, tickets + 1):
+            created = start + timedelta(minutes=rng.randint(0, 60 * 24 * 540))
+            resolved = created + timedelta(hours=rng.randint(1, 240)) if rng.random() < 0.7 else None
+            yield json.dumps({
+                'id': i, 'customer_id': rng.randint(1, customers), 'subject': f'Issue {i}',
+                'status': 'resolved' if resolved else rng.choice(['open', 'in_progress']),
+                'priority': rng.choice(['low', 'medium', 'high', 'urgent']),
+                'created_at': created.isoformat(),
+                'resolved_at': resolved.isoformat() if resolved else None
+            })
+    yield 'support_tickets', tickets_stream()
+    
+    def interactions_stream():
+        agents = ['Alice Cooper', 'Bob Martinez', 'Carol Davies', 'Dan Lee', 'Emma Wilson']
+        for i in range(1, tickets * 4 + 1):
+            kind = rng.choice(['email', 'chat', 'phone', 'note'])
+            yield json.dumps({
+                'id': i, 'ticket_id': rng.randint(1, tickets), 'interaction_type': kind,
+                'timestamp': (start + timedelta(minutes=rng.randint(0, 60 * 24 * 540))).isoformat(),
+                'agent_name': rng.choice(agents),
+                'duration_minutes': rng.randint(5, 45) if kind in ('chat', 'phone') else None
+            })
+    yield 'interactions', interactions_stream()
+
+def _time_query(execute, sql, repeat):
+    """run a query repeatedly and return (median ms, columns, rows)"""
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        columns, rows = execute(sql)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    return statistics.median(timings), columns, [tuple(row) for row in rows]
+
+def _compare(sqlite_result, duckdb_result):
+    """describe how the two engines' results relate"""
+    _, sqlite_columns, sqlite_rows = sqlite_result
+    _, duckdb_columns, duckdb_rows = duckdb_result
+    if list(sqlite_columns) != list(duckdb_columns):
+        return 'DIFFERENT COLUMNS'
+    if sqlite_rows == duckdb_rows:
+        # 14 == 14.0, but an int where sqlite returns a real still changes the response
+        def types(rows):
+            return [tuple(type(v) for v in row) for row in rows]
+        return 'identical' if types(sqlite_rows) == types(duckdb_rows) else 'DIFFERENT TYPES'
+        
+    # floats may differ in the last bits when summed in a different order
+    def rounded(rows):
+        return [tuple(round(v, 9) if isinstance(v, float) else v for v in row) for row in rows]
+    if rounded(sqlite_rows) == rounded(duckdb_rows):
+        return 'identical (float rounding)'
+    if sorted(map(repr, rounded(sqlite_rows))) == sorted(map(repr, rounded(duckdb_rows))):
+        return 'same rows, tie order differs'
+    return 'DIFFERENT'
+
+def bench_engines(args):
+    """compare sqlite and duckdb on the cx workload"""
+    workdir = tempfile.mkdtemp(prefix='apexion-bench-')
+    try:
+        if not args.database:
+            os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        os.environ['QUERY_ENGINE'] = 'auto'
+        os.environ['DUCKDB_SNAPSHOT_PATH'] = os.path.join(workdir, 'bench.duckdb')
+        os.environ['SCHEMA_CACHE_PATH'] = os.path.join(workdir, 'schema_cache.json')
+        
+        from app import create_app
+        from execution import get_router
+        from ingest import ingest_stream
+        
+        app = create_app()
+        with app.app_context():
+            if not args.database:
+                print(f'Generating synthetic data ({args.tickets} tickets, {args.tickets * 4} interactions)...')
+                for table, lines in _synthetic_records(args.tickets):
+                    result = ingest_stream(table, lines, app.config['INGEST_BATCH_SIZE'])
+                    print(f"  {table}: {result['upserted']} rows at {result['rows_per_second']} rows/s")
+                    
+            router = get_router()
+            if router.duckdb is None:
+                print('duckdb is not installed; nothing to compare.')
+                return 1
+                
+            start_time = time.perf_counter()
+            router.duckdb.refresh()
+            print(f'DuckDB snapshot refresh: {(time.perf_counter() - start_time) * 1000:.0f} ms\n')
+            
+            print(f"{'query':<45} {'route':<7} {'sqlite ms':>10} {'duckdb ms':>10} {'speedup':>8}  result")
+            for label, sql in ENGINE_WORKLOAD:
+                route = router.choose(sql).name
+                sqlite_result = _time_query(router.sqlite.execute, sql, args.repeat)
+                try:
+                    duckdb_result = _time_query(router.execute_on_duckdb, sql, args.repeat)
+                except Exception as e:
+                    print(f'{label:<45} {route:<7} {sqlite_result[0]:>10.2f} {"n/a":>10} {"":>8}  duckdb error: {str(e).splitlines()[0][:40]}')
+                    continue
+                speedup = sqlite_result[0] / duckdb_result[0] if duckdb_result[0] else 0
+                print(f'{label:<45} {route:<7} {sqlite_result[0]:>10.2f} {duckdb_result[0]:>10.2f} '
+                      f'{speedup:>7.1f}x  {_compare(sqlite_result, duckdb_result)}')
+        return 0
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def _startup_env(workdir, lazy):
+    """environment for a child process that starts the app against scratch files in workdir"""
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'startup.db')}",
+        'SHARED_CACHE_PATH': os.path.join(workdir, 'shared_cache.db'),
+        'SCHEMA_CACHE_PATH': os.path.join(workdir, 'schema_cache.json'),
+        'LAZY_INIT': 'true' if lazy else 'false',
+        'OPENAI_API_KEY': env.get('OPENAI_API_KEY') or 'sk-benchmark'
+    })
+    return env
+
+def bench_imports(args):
+    """report what importing the app costs, module by module"""
+    workdir = tempfile.mkdtemp(prefix='apexion-bench-')
+    try:
+        child = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import app'],
+            env=_startup_env(workdir, args.lazy), capture_output=True, text=True
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if child.returncode != 0:
+        print(child.stderr)
+        return 1
+    
+    # lines look like "import time:  self [us] | cumulative | <indent>module"
+    modules = []
+    for line in child.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    
+    packages = {}
+    for name, self_us, _ in modules:
+        package = name.split('.')[0]
+        packages[package] = packages.get(package, 0) + self_us
+    total_us = sum(packages.values())
+    
+    print(f"import app ({'lazy' if args.lazy else 'eager'} init): {len(modules)} modules, {total_us / 1000:.0f} ms\n")
+    print(f"{'package':<30} {'self ms':>9} {'share':>6}")
+    for package, self_us in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{package:<30} {self_us / 1000:>9.1f} {self_us / total_us:>6.1%}')
+    
+    print(f"\n{'module':<50} {'self ms':>9} {'cumulative ms':>14}")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda module: -module[2])[:args.top]:
+        print(f'{name:<50} {self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}')
+    return 0
+
+# runs in a fresh interpreter: time the app import, the first /health and the first query engine
+STARTUP_PROBE = """
+import json, sys, time
+imported_at = time.time()
+import app
+ready_at = time.time()
+response = app.app.test_client().get('/health')
+assert response.status_code == 200, response.status_code
+served_at = time.time()
+openai_loaded = 'openai' in sys.modules
+with app.app.app_context():
+    app.get_query_engine()
+print(json.dumps({
+    'interpreter': imported_at, 'import': ready_at, 'health': served_at, 'engine': time.time(),
+    'openai_loaded': openai_loaded
+}))
+"""
+
+def _start_once(workdir, lazy):
+    """spawn a fresh process and return its milestones in ms since the spawn"""
+    spawned_at = time.time()
+    child = subprocess.run(
+        [sys.executable, '-c', STARTUP_PROBE], env=_startup_env(workdir, lazy), capture_output=True, text=True
+    )
+    if child.returncode != 0:
+        raise RuntimeError(child.stderr.strip().splitlines()[-1])
+    milestones = json.loads(child.stdout.strip().splitlines()[-1])
+    return {
+        'interpreter': (milestones['interpreter'] - spawned_at) * 1000,
+        'import': (milestones['import'] - milestones['interpreter']) * 1000,
+        'health': (milestones['health'] - spawned_at) * 1000,
+        'engine': (milestones['engine'] - milestones['health']) * 1000,
+        # lazy init works when the sdk is still unloaded once /health has been served
+        'openai_loaded': milestones['openai_loaded']
+    }
+
+def bench_startup(args):
+    """measure cold start to the first served /health, eager versus lazy init"""
+    workdir = tempfile.mkdtemp(prefix='apexion-bench-')
+    schema_path = _startup_env(workdir, False)['SCHEMA_CACHE_PATH']
+    try:
+        # the first start creates the database; every measured start finds it in place
+        _start_once(workdir, False)
+        
+        print(f"{'init':<6} {'schema cache':<13} {'to /health ms':>14} {'python ms':>10} {'import app ms':>14} "
+              f"{'first engine ms':>16} {'openai at /health':>18}")
+        for lazy in (False, True):
+            for warm in (False, True):
+                runs = []
+                for _ in range(args.repeat):
+                    # a cold start is a worker on a fresh host, with nothing cached on disk
+                    if not warm and os.path.exists(schema_path):
+                        os.remove(schema_path)
+                    runs.append(_start_once(workdir, lazy))
+                median = {key: statistics.median(run[key] for run in runs) for key in runs[0] if key != 'openai_loaded'}
+                openai_loaded = 'loaded' if any(run['openai_loaded'] for run in runs) else 'not loaded'
+                print(f"{'lazy' if lazy else 'eager':<6} {'warm' if warm else 'cold':<13} {median['health']:>14.0f} "
+                      f"{median['interpreter']:>10.0f} {median['import']:>14.0f} {median['engine']:>16.0f} "
+                      f"{openai_loaded:>18}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Performance benchmarks for Apexion CX Copilot.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    engines = subparsers.add_parser('engines', help='compare the sqlite and duckdb execution engines')
+    engines.add_argument('--database', action='store_true',
+                         help='benchmark the configured DATABASE_URL instead of synthetic data')
+    engines.add_argument('--tickets', type=int, default=100000, help='synthetic ticket count')
+    engines.add_argument('--repeat', type=int, default=5, help='runs per query (median is reported)')
+    engines.set_defaults(handler=bench_engines)
+    
+    imports = subparsers.add_parser('imports', help='profile the import time of the app per module')
+    imports.add_argument('--lazy', action='store_true', help='profile with LAZY_INIT enabled')
+    imports.add_argument('--top', type=int, default=15, help='packages and modules to list')
+    imports.set_defaults(handler=bench_imports)
+    
+    startup = subparsers.add_parser('startup', help='measure cold start to the first served /health')
+    startup.add_argument('--repeat', type=int, default=5, help='starts per configuration (median is reported)')
+    startup.set_defaults(handler=bench_startup)
+    
+    args = parser.parse_args(argv)
+    return args.handler(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,16 +10,65 @@ class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'dev-secret-key-change-in-production')
     
     # database settings
-    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///apexion_cx.db')
+    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', 'sqlite:///apexion_cx.db')  # sqlite only
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # openai settings
     OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
     
+    # llm admission control: one budget shared by all workers (0 disables);
+    # callers that would wait longer than their priority allows get a "busy, retry" response
+    LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', 500))
+    LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', 150000))
+    LLM_MAX_WAIT_INTERACTIVE = float(os.getenv('LLM_MAX_WAIT_INTERACTIVE', 5))  # seconds
+    LLM_MAX_WAIT_SUMMARY = float(os.getenv('LLM_MAX_WAIT_SUMMARY', 20))
+    LLM_MAX_WAIT_BATCH = float(os.getenv('LLM_MAX_WAIT_BATCH', 120))
+    LLM_QUEUE_LIMIT = int(os.getenv('LLM_QUEUE_LIMIT', 64))  # waiting calls per worker process
+    LLM_COMPLETION_TOKENS = int(os.getenv('LLM_COMPLETION_TOKENS', 300))  # budgeted before usage is known
+    
     # application settings
     APP_NAME = os.getenv('APP_NAME', 'Apexion CX Copilot')
     MAX_QUERY_RESULTS = int(os.getenv('MAX_QUERY_RESULTS', 100))
     
+    # total row counts of truncated results stop at this many rows ("100000+") or seconds
+    COUNT_LIMIT = int(os.getenv('COUNT_LIMIT', 100000))
+    COUNT_TIMEOUT = float(os.getenv('COUNT_TIMEOUT', 5))
+    
+    # summary settings: inline (in the /query response), deferred (fetched from /summary)
+    # or background (deferred, but started as soon as the query has run)
+    SUMMARY_MODE = os.getenv('SUMMARY_MODE', 'inline')
+    SUMMARY_WORKERS = int(os.getenv('SUMMARY_WORKERS', 4))
+    SUMMARY_RESULTS_TTL = int(os.getenv('SUMMARY_RESULTS_TTL', 600))  # seconds deferred rows are kept
+    
+    # follow-up questions refine the session's previous answer while it is this recent (seconds)
+    CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', 1800))
+    
+    # cache shared by all worker processes on the host (defaults to instance/shared_cache.db)
+    SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH')
+    
+    # startup settings: lazy init defers the query engine and openai sdk imports to the first
+    # query; the schema check at startup is skipped while the database matches the cached state
+    LAZY_INIT = os.getenv('LAZY_INIT', 'false').lower() in ('1', 'true', 'yes')
+    SCHEMA_CACHE_PATH = os.getenv('SCHEMA_CACHE_PATH')  # defaults to instance/schema_cache.json
+    
+    # response settings
+    COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))  # smaller bodies are sent as-is
+    COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+    
+    # query execution settings
+    QUERY_ENGINE = os.getenv('QUERY_ENGINE', 'sqlite')  # sqlite, auto (route aggregates to duckdb) or duckdb
+    DUCKDB_SNAPSHOT_PATH = os.getenv('DUCKDB_SNAPSHOT_PATH')  # defaults to instance/analytics.duckdb
+    
+    # ingestion settings
+    INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 5000))
+    INGEST_TOKEN = os.getenv('INGEST_TOKEN')  # bearer token required by /ingest; unset disables it
+    
     # logging settings
     LOG_TO_DATABASE = True
     LOG_TO_FILE = True
+    
+    # log retention: rows older than the hot window move to compressed archives
+    LOG_RETENTION_DAYS = int(os.getenv('LOG_RETENTION_DAYS', 90))
+    ARCHIVE_DIR = os.getenv('ARCHIVE_DIR')  # defaults to instance/archive
+    RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 5000))
+    VACUUM_PAGES_PER_RUN = int(os.getenv('VACUUM_PAGES_PER_RUN', 2000))
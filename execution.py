@@ -0,0 +1,358 @@
+import json
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from flask import current_app
+from models import db
+from ingest import mark_tables_changed
+
+# optional dependency, only needed for the analytical engine; imported by get_router
+# when an engine other than sqlite is configured, since it is slow to import
+duckdb = None
+
+def _import_duckdb():
+    """import duckdb on first use; returns None when it is not installed"""
+    global duckdb
+    if duckdb is None:
+        try:
+            import duckdb as module
+        except ImportError:
+            return None
+        duckdb = module
+    return duckdb
+
+# tables copied into the columnar snapshot
+SNAPSHOT_TABLES = [
+    'customers', 'support_tickets', 'interactions', 'customer_notes',
+    'ticket_metrics', 'agent_metrics', 'tier_metrics'
+]
+
+# sqlite declared type -> duckdb column type; datetimes stay text so comparisons match sqlite
+DUCKDB_TYPES = {
+    'INTEGER': 'BIGINT',
+    'FLOAT': 'DOUBLE',
+    'REAL': 'DOUBLE',
+    'BOOLEAN': 'BOOLEAN'
+}
+
+# queries that aggregate are worth a trip to the columnar engine
+AGGREGATE_PATTERN = re.compile(r'\bgroup\s+by\b|\b(count|sum|avg|min|max)\s*\(')
+
+# constructs whose semantics differ between sqlite and duckdb, so those queries stay on sqlite
+# (round returns a real on sqlite but keeps integer inputs integral on duckdb)
+SQLITE_ONLY_PATTERN = re.compile(
+    r'\b(like|glob|julianday|strftime|datetime|date|time|unixepoch|total|group_concat|printf|typeof|random|round)\b'
+)
+
+# casts to integer truncate on sqlite but round on duckdb
+INTEGER_CAST_PATTERN = re.compile(r'\bas\s+(integer|int|bigint|smallint|tinyint)\b')
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+
+# settings that give duckdb sqlite semantics for integer division and null ordering;
+# they are per session, and every cursor is a session of its own
+SQLITE_COMPATIBLE_SETTINGS = [
+    'SET integer_division = true',
+    "SET default_null_order = 'nulls_first_on_asc_last_on_desc'"
+]
+
+def _clause_items(sql, start_pattern, end_pattern):
+    """comma-separated top-level items of the clause after the last start_pattern match"""
+    matches = list(re.finditer(start_pattern, sql))
+    if not matches:
+        return None
+    clause = sql[matches[-1].end():]
+    end = re.search(end_pattern, clause)
+    if end:
+        clause = clause[:end.start()]
+    clause = clause.strip().rstrip(';')
+
+    items, depth, current = [], 0, ''
+    for char in clause:
+        depth += (char == '(') - (char == ')')
+        if char == ',' and depth == 0:
+            items.append(current)
+            current = ''
+        else:
+            current += char
+    items.append(current)
+    return [' '.join(item.split()) for item in items if item.strip()]
+
+def has_total_order(sql_lower):
+    """true when order by fixes the position of every row of a single grouped select
+    
+    ties are returned in whatever order each engine happens to produce them, which
+    changes the rows a limit keeps and the order of the rest, so only orderings that
+    cover every group by key are trusted
+    """
+    if len(re.findall(r'\bselect\b', sql_lower)) != 1:
+        return False
+    order_items = _clause_items(sql_lower, r'\border\s+by\b', r'\blimit\b') or []
+    order_keys = {re.sub(r'\s+(asc|desc)?(\s*nulls\s+(first|last))?$', '', item) for item in order_items}
+    group_keys = _clause_items(sql_lower, r'\bgroup\s+by\b', r'\b(having|order\s+by|limit)\b')
+    # an aggregate without group by returns a single row
+    return group_keys is None or set(group_keys) <= order_keys
+
+def is_analytical(sql):
+    """decide whether a select belongs on the columnar engine"""
+    # ignore keywords that only appear inside string literals
+    sql_lower = STRING_LITERAL_PATTERN.sub("''", sql.lower())
+    
+    # without an explicit order the two engines may return rows in different orders
+    if not re.search(r'\border\s+by\b', sql_lower):
+        return False
+    if SQLITE_ONLY_PATTERN.search(sql_lower) or INTEGER_CAST_PATTERN.search(sql_lower):
+        return False
+    if not has_total_order(sql_lower):
+        return False
+    return bool(AGGREGATE_PATTERN.search(sql_lower))
+
+def _normalize_value(value):
+    """coerce duckdb result types to what sqlite would have returned"""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+class SQLiteBackend:
+    """runs queries on the application database through sqlalchemy"""
+    name = 'sqlite'
+    
+    def execute(self, sql):
+        result = db.session.execute(db.text(sql))
+        return list(result.keys()), result.fetchall()
+    
+    def column_names(self, sql):
+        """the names sqlite gives a query's result columns, without running it"""
+        result = db.session.execute(db.text(f'SELECT * FROM ({sql}) LIMIT 0'))
+        return list(result.keys())
+
+class ResultSetBackend:
+    """runs queries on one already-fetched result set, exposed as an in-memory table"""
+    name = 'memory'
+    
+    def __init__(self, table_name, columns, rows):
+        self.table_name = table_name
+        self.columns = columns
+        self.rows = rows
+    
+    def execute(self, sql):
+        connection = sqlite3.connect(':memory:')
+        try:
+            names = ', '.join('"' + column.replace('"', '""') + '"' for column in self.columns)
+            placeholders = ', '.join('?' * len(self.columns))
+            connection.execute(f'CREATE TABLE {self.table_name} ({names})')
+            connection.executemany(f'INSERT INTO {self.table_name} VALUES ({placeholders})', self.rows)
+            cursor = connection.execute(sql)
+            return [description[0] for description in cursor.description], cursor.fetchall()
+        finally:
+            connection.close()
+
+class DuckDBBackend:
+    """runs queries on a columnar duckdb copy of the sqlite data tables"""
+    name = 'duckdb'
+    
+    def __init__(self, sqlite_path, snapshot_path):
+        self.sqlite_path = sqlite_path
+        self.snapshot_path = snapshot_path
+        self._connection = None
+        self._connection_mtime = None
+        self._versions = None
+        self._refresh_lock = threading.Lock()
+        self._connection_lock = threading.Lock()
+        
+    def _source_versions(self, connection):
+        """current table versions recorded by writers of the sqlite database"""
+        placeholders = ','.join('?' * len(SNAPSHOT_TABLES))
+        rows = connection.execute(
+            f'SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})',
+            SNAPSHOT_TABLES
+        ).fetchall()
+        return {name: version for name, version in rows}
+        
+    def refresh(self):
+        """rebuild the snapshot from one consistent read of the sqlite file"""
+        if not self._refresh_lock.acquire(blocking=False):
+            return False
+            
+        try:
+            source = sqlite3.connect(self.sqlite_path)
+            
+            # tables never stamped by a writer get a version now, so later writes are detectable
+            missing = [table for table in SNAPSHOT_TABLES if table not in self._source_versions(source)]
+            if missing:
+                mark_tables_changed(source.cursor(), missing)
+                source.commit()
+                
+            build_path = f'{self.snapshot_path}.{os.getpid()}.tmp'
+            if os.path.exists(build_path):
+                os.remove(build_path)
+                
+            target = duckdb.connect(build_path)
+            try:
+                # a single read transaction keeps the tables and their versions consistent; the
+                # main database runs in wal mode (see create_app), so writers are not blocked meanwhile
+                source.execute('BEGIN')
+                versions = self._source_versions(source)
+                
+                with tempfile.TemporaryDirectory() as workdir:
+                    for table in SNAPSHOT_TABLES:
+                        self._copy_table(source, target, table, workdir)
+                        
+                target.execute('CREATE TABLE _snapshot_versions (table_name VARCHAR, version BIGINT)')
+                target.executemany('INSERT INTO _snapshot_versions VALUES (?, ?)', list(versions.items()))
+            finally:
+                source.close()
+                target.close()
+                
+            # readers either see the old snapshot or the new one, never a partial build
+            os.replace(build_path, self.snapshot_path)
+            return True
+        finally:
+            self._refresh_lock.release()
+            
+    def _copy_table(self, source, target, table, workdir):
+        """copy one table through newline-delimited json, which keeps nulls distinct from ''"""
+        columns = [
+            (name, DUCKDB_TYPES.get((declared or '').split('(')[0].upper(), 'VARCHAR'))
+            for _, name, declared, *_ in source.execute(f'PRAGMA table_info({table})')
+        ]
+        names = [name for name, _ in columns]
+        
+        path = os.path.join(workdir, f'{table}.ndjson')
+        with open(path, 'w') as f:
+            for row in source.execute(f"SELECT {', '.join(names)} FROM {table}"):
+                f.write(json.dumps(dict(zip(names, row))))
+                f.write('\n')
+                
+        column_types = ', '.join(f"'{name}': '{kind}'" for name, kind in columns)
+        target.execute(f"CREATE TABLE {table} ({', '.join(f'{name} {kind}' for name, kind in columns)})")
+        target.execute(
+            f"INSERT INTO {table} SELECT * FROM read_json(?, format='newline_delimited', columns={{{column_types}}})",
+            [path]
+        )
+        
+    def _open(self):
+        """return a connection to the newest snapshot, reopening after a refresh"""
+        with self._connection_lock:
+            mtime = os.path.getmtime(self.snapshot_path)
+            if self._connection is None or mtime != self._connection_mtime:
+                if self._connection is not None:
+                    self._connection.close()
+                connection = duckdb.connect(self.snapshot_path, read_only=True)
+                self._versions = dict(connection.execute('SELECT table_name, version FROM _snapshot_versions').fetchall())
+                self._connection = connection
+                self._connection_mtime = mtime
+            return self._connection, self._versions
+            
+    def is_fresh(self):
+        """true when the snapshot holds exactly the data currently in sqlite"""
+        if not os.path.exists(self.snapshot_path):
+            return False
+        _, versions = self._open()
+        source = sqlite3.connect(self.sqlite_path)
+        try:
+            return self._source_versions(source) == versions
+        finally:
+            source.close()
+            
+    def refresh_in_background(self):
+        """rebuild the snapshot without blocking the current request"""
+        threading.Thread(target=self.refresh, daemon=True).start()
+        
+    def execute(self, sql):
+        connection, _ = self._open()
+        cursor = connection.cursor()
+        try:
+            for setting in SQLITE_COMPATIBLE_SETTINGS:
+                cursor.execute(setting)
+            cursor.execute(sql)
+            columns = [description[0] for description in cursor.description]
+            rows = [tuple(_normalize_value(value) for value in row) for row in cursor.fetchall()]
+            return columns, rows
+        finally:
+            cursor.close()
+
+class QueryRouter:
+    """sends aggregation-heavy selects to duckdb and everything else to sqlite"""
+    
+    def __init__(self, mode, sqlite_backend, duckdb_backend=None):
+        self.mode = mode
+        self.sqlite = sqlite_backend
+        self.duckdb = duckdb_backend
+        
+    def choose(self, sql):
+        """pick the backend for a query without running it"""
+        if self.duckdb is None or self.mode == 'sqlite':
+            return self.sqlite
+        if self.mode == 'duckdb' or is_analytical(sql):
+            # stale or missing snapshots would change results, so fall back until rebuilt
+            if self.duckdb.is_fresh():
+                return self.duckdb
+            self.duckdb.refresh_in_background()
+        return self.sqlite
+        
+    def execute_on_duckdb(self, sql):
+        """run a query on duckdb and return (columns, rows) named the way sqlite names them"""
+        columns, rows = self.duckdb.execute(sql)
+        # unaliased expressions are named differently (count_star() vs COUNT(*)), which
+        # would change row keys, table headers and the columns follow-ups see
+        names = self.sqlite.column_names(sql)
+        if len(names) != len(columns):
+            raise duckdb.Error(f'duckdb returned {len(columns)} columns, sqlite {len(names)}')
+        return names, rows
+    
+    def execute(self, sql):
+        """run a query and return (columns, rows, backend name)"""
+        backend = self.choose(sql)
+        if backend is self.duckdb:
+            try:
+                columns, rows = self.execute_on_duckdb(sql)
+                return columns, rows, backend.name
+            except duckdb.Error:
+                # dialect differences surface as errors; sqlite is the reference engine
+                pass
+        columns, rows = self.sqlite.execute(sql)
+        return columns, rows, self.sqlite.name
+
+_routers = {}
+
+def get_router():
+    """return the process-wide router for the current app configuration"""
+    mode = current_app.config['QUERY_ENGINE']
+    sqlite_path = db.engine.url.database
+    key = (mode, sqlite_path)
+    
+    if key not in _routers:
+        duckdb_backend = None
+        if mode != 'sqlite':
+            if _import_duckdb() is None:
+                print(f"WARNING: QUERY_ENGINE={mode} requires the duckdb package; using sqlite.")
+            else:
+                snapshot_path = current_app.config['DUCKDB_SNAPSHOT_PATH'] or os.path.join(
+                    current_app.instance_path, 'analytics.duckdb'
+                )
+                duckdb_backend = DuckDBBackend(sqlite_path, snapshot_path)
+        _routers[key] = QueryRouter(mode, SQLiteBackend(), duckdb_backend)
+        
+    return _routers[key]
+
+if __name__ == '__main__':
+    # rebuild the duckdb snapshot ahead of traffic, e.g. right after a helpdesk sync
+    from app import create_app
+    app = create_app()
+    
+    with app.app_context():
+        router = get_router()
+        if router.duckdb is None:
+            print('DuckDB engine is not enabled (set QUERY_ENGINE=auto and install duckdb).')
+            sys.exit(1)
+        start_time = time.perf_counter()
+        router.duckdb.refresh()
+        print(f'Snapshot written to {router.duckdb.snapshot_path} in {time.perf_counter() - start_time:.2f}s')
@@ -0,0 +1,37 @@
+"""production server configuration: gunicorn -c gunicorn.conf.py app:app"""
+import multiprocessing
+import os
+from dotenv import load_dotenv
+
+# gunicorn reads this file before the app loads .env, so settings below come from it too
+load_dotenv()
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+
+# one process per core for python work, threads for requests waiting on the openai api
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', multiprocessing.cpu_count() * 2))
+
+# import the app once in the master so startup state is shared copy-on-write
+preload_app = True
+
+# recycle workers gradually so slow leaks never build up, without restarting them all at once
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# llm round trips can take tens of seconds; let in-flight requests finish on reload or shutdown
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 60))
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+def post_fork(server, worker):
+    """drop database connections inherited from the preloaded master"""
+    from app import app
+    from models import db
+    
+    with app.app_context():
+        db.engine.dispose(close=False)
@@ -0,0 +1,402 @@
+import argparse
+import gzip
+import json
+import math
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from models import db, DATETIME_FORMAT, Customer, SupportTicket, Interaction, CustomerNote
+from analytics import (
+    new_changes, collect_changes, last_id, collect_inserted, refresh_ticket_metrics, refresh_rollups
+)
+
+# tables accepted by the ingestion api, in foreign key dependency order
+INGEST_MODELS = {
+    'customers': Customer,
+    'support_tickets': SupportTicket,
+    'interactions': Interaction,
+    'customer_notes': CustomerNote
+}
+
+# stay well below sqlite's bound parameter limit for IN (...) lookups
+MAX_LOOKUP_PARAMS = 900
+
+# range of sqlite's 64-bit integers
+MIN_INTEGER, MAX_INTEGER = -2 ** 63, 2 ** 63 - 1
+
+# cap the number of per-row errors returned to the caller
+MAX_REPORTED_ERRORS = 50
+
+# stamps a table as written so analytical snapshots of it can detect staleness
+TABLE_VERSION_SQL = (
+    'INSERT INTO table_versions (table_name, version, updated_at) VALUES (?, ?, ?) '
+    'ON CONFLICT(table_name) DO UPDATE SET version = excluded.version, updated_at = excluded.updated_at'
+)
+
+def _to_datetime_text(value):
+    """normalize an iso-8601 string or epoch seconds to sqlalchemy's sqlite datetime format"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        parsed = datetime.fromtimestamp(value, tz=timezone.utc)
+    elif isinstance(value, str):
+        parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    else:
+        raise ValueError(f'invalid datetime value: {value!r}')
+        
+    # the app stores naive utc timestamps
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed.strftime(DATETIME_FORMAT)
+
+def _to_integer(value):
+    """accept integral numbers or numeric strings that fit in a sqlite integer"""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    elif isinstance(value, str):
+        value = int(value.strip())
+    elif isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError('expected an integer')
+    if not MIN_INTEGER <= value <= MAX_INTEGER:
+        raise ValueError('integer out of range')
+    return value
+
+def _to_float(value):
+    """accept finite numbers or numeric strings"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('expected a number')
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('number out of range')
+    return value
+
+def _to_text(value):
+    """accept strings, and numbers as their json text"""
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise ValueError('expected a string')
+    return value if isinstance(value, str) else json.dumps(value)
+
+def _to_boolean(value):
+    """accept json booleans or 0/1"""
+    if value not in (True, False) or not isinstance(value, (bool, int)):
+        raise ValueError('expected a boolean')
+    return int(value)
+
+def _converter(column_type):
+    """value converter for a column type; anything that cannot be stored as-is is rejected"""
+    if isinstance(column_type, db.DateTime):
+        return _to_datetime_text
+    if isinstance(column_type, db.Boolean):
+        return _to_boolean
+    if isinstance(column_type, db.Integer):
+        return _to_integer
+    if isinstance(column_type, db.Float):
+        return _to_float
+    return _to_text
+
+def mark_tables_changed(cursor, table_names):
+    """record a new version for each table inside the caller's transaction"""
+    now = datetime.utcnow().strftime(DATETIME_FORMAT)
+    cursor.executemany(TABLE_VERSION_SQL, [(name, time.time_ns(), now) for name in table_names])
+
+class BulkIngestor:
+    """streams ndjson records into one table using batched upserts"""
+    
+    def __init__(self, table_name, batch_size=5000):
+        if table_name not in INGEST_MODELS:
+            raise ValueError(f'Unknown table: {table_name}')
+            
+        table = INGEST_MODELS[table_name].__table__
+        self.table_name = table_name
+        self.batch_size = batch_size
+        self.columns = {column.name: column for column in table.columns}
+        self.primary_key = table.primary_key.columns.keys()[0]
+        self.required = [
+            name for name, column in self.columns.items()
+            if not column.nullable and not column.primary_key
+        ]
+        self.converters = {name: _converter(column.type) for name, column in self.columns.items()}
+        
+        # python-side defaults (e.g. created_at) that raw sql would otherwise skip
+        self.defaults = {
+            name: column.default.arg for name, column in self.columns.items()
+            if column.default is not None and column.default.is_callable
+        }
+        
+        # foreign key column -> (parent table, parent column)
+        self.foreign_keys = {}
+        for name, column in self.columns.items():
+            for fk in column.foreign_keys:
+                self.foreign_keys[name] = (fk.column.table.name, fk.column.name)
+                
+        # parent keys already confirmed to exist, so each is looked up once per stream
+        self.known_keys = {parent: set() for parent, _ in self.foreign_keys.values()}
+        
+        # metric keys touched by this stream
+        self.changes = new_changes()
+        
+        self.stats = {
+            'received': 0,
+            'upserted': 0,
+            'rejected': 0,
+            'batches': 0,
+            'errors': []
+        }
+        
+    def _reject(self, line_number, message):
+        """record a rejected row"""
+        self.stats['rejected'] += 1
+        if len(self.stats['errors']) < MAX_REPORTED_ERRORS:
+            self.stats['errors'].append({'line': line_number, 'error': message})
+            
+    def _normalize(self, record):
+        """validate one decoded record and coerce it to column values"""
+        if not isinstance(record, dict):
+            raise ValueError('record must be a json object')
+            
+        unknown = [key for key in record if key not in self.columns]
+        if unknown:
+            raise ValueError(f"unknown columns: {', '.join(unknown)}")
+            
+        nulls = [name for name in self.required if name in record and record[name] is None]
+        if nulls:
+            raise ValueError(f"required columns cannot be null: {', '.join(nulls)}")
+        
+        # rows without every required column can only update an existing row (checked per batch)
+        missing = [name for name in self.required if name not in record]
+        if missing and record.get(self.primary_key) is None:
+            raise ValueError(f"missing required columns: {', '.join(missing)}")
+            
+        row = {}
+        for name, value in record.items():
+            if value is not None:
+                try:
+                    value = self.converters[name](value)
+                except (ValueError, TypeError, OverflowError, OSError) as e:
+                    raise ValueError(f'invalid value for {name} ({e}): {json.dumps(value)[:100]}')
+            row[name] = value
+            
+        # only columns sent by the source are overwritten on conflict
+        provided = tuple(name for name in row if name != self.primary_key)
+        if missing and not provided:
+            raise ValueError('no columns to update')
+        for name, default in self.defaults.items():
+            if name not in row:
+                value = default(None)
+                row[name] = value.strftime(DATETIME_FORMAT) if isinstance(value, datetime) else value
+        return row, provided
+        
+    def _existing_keys(self, cursor, parent_table, parent_column, keys):
+        """return the subset of keys present in the parent table"""
+        found = set()
+        keys = list(keys)
+        for start in range(0, len(keys), MAX_LOOKUP_PARAMS):
+            chunk = keys[start:start + MAX_LOOKUP_PARAMS]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(
+                f'SELECT {parent_column} FROM {parent_table} WHERE {parent_column} IN ({placeholders})',
+                chunk
+            )
+            found.update(row[0] for row in cursor.fetchall())
+        return found
+        
+    def _check_foreign_keys(self, cursor, batch):
+        """validate every foreign key in the batch with one lookup per parent table"""
+        for name, (parent_table, parent_column) in self.foreign_keys.items():
+            known = self.known_keys[parent_table]
+            wanted = {row[name] for _, row, _ in batch if row.get(name) is not None} - known
+            if wanted:
+                known.update(self._existing_keys(cursor, parent_table, parent_column, wanted))
+                
+        valid = []
+        for line_number, row, provided in batch:
+            for name, (parent_table, _) in self.foreign_keys.items():
+                if row.get(name) is not None and row[name] not in self.known_keys[parent_table]:
+                    self._reject(line_number, f'{name}={row[name]} does not exist in {parent_table}')
+                    break
+            else:
+                valid.append((line_number, row, provided))
+        return valid
+        
+    def _is_partial(self, row):
+        """true when a row lacks required columns and so can only update an existing row"""
+        return any(name not in row for name in self.required)
+    
+    def _check_partial_rows(self, cursor, batch):
+        """keep partial rows only when their key exists, with one lookup per batch"""
+        complete_keys = {row.get(self.primary_key) for _, row, _ in batch if not self._is_partial(row)}
+        wanted = {row[self.primary_key] for _, row, _ in batch if self._is_partial(row)} - complete_keys
+        existing = complete_keys
+        if wanted:
+            existing = existing | self._existing_keys(cursor, self.table_name, self.primary_key, wanted)
+        
+        valid = []
+        for line_number, row, provided in batch:
+            if self._is_partial(row) and row[self.primary_key] not in existing:
+                missing = [name for name in self.required if name not in row]
+                self._reject(
+                    line_number,
+                    f"{self.primary_key}={row[self.primary_key]} does not exist and the row is "
+                    f"missing required columns: {', '.join(missing)}"
+                )
+            else:
+                valid.append((line_number, row, provided))
+        return valid
+    
+    def _statement(self, columns, provided, partial):
+        """build the write for one row layout; returns (sql, parameter column names)
+        
+        complete rows are inserted, updating the provided columns when the primary key exists;
+        partial rows update the provided columns of their existing row
+        """
+        if partial:
+            updates = ', '.join(f'{name} = ?' for name in provided)
+            return f'UPDATE {self.table_name} SET {updates} WHERE {self.primary_key} = ?', provided + (self.primary_key,)
+        
+        placeholders = ', '.join('?' * len(columns))
+        sql = f"INSERT INTO {self.table_name} ({', '.join(columns)}) VALUES ({placeholders})"
+        if self.primary_key in columns:
+            updates = ', '.join(f'{name} = excluded.{name}' for name in provided)
+            if updates:
+                sql += f' ON CONFLICT({self.primary_key}) DO UPDATE SET {updates}'
+            else:
+                sql += f' ON CONFLICT({self.primary_key}) DO NOTHING'
+        return sql, columns
+        
+    def _flush(self, connection, batch):
+        """write one batch inside a single transaction"""
+        if not batch:
+            return
+            
+        cursor = connection.cursor()
+        try:
+            batch = self._check_foreign_keys(cursor, batch)
+            batch = self._check_partial_rows(cursor, batch)
+            collect_changes(cursor, self.table_name, [row for _, row, _ in batch], self.changes)
+            unnumbered = any(row.get(self.primary_key) is None for _, row, _ in batch)
+            after_id = last_id(cursor, self.table_name) if unnumbered else None
+            
+            # group rows by column layout so each group is a single executemany;
+            # partial updates run last, after the rows they may depend on were inserted
+            groups = {}
+            for line_number, row, provided in batch:
+                key = (tuple(row), provided, self._is_partial(row))
+                groups.setdefault(key, []).append((line_number, row))
+            groups = sorted(groups.items(), key=lambda group: group[0][2])
+            
+            try:
+                for layout, rows in groups:
+                    sql, names = self._statement(*layout)
+                    cursor.executemany(sql, [tuple(row[name] for name in names) for _, row in rows])
+                written = len(batch)
+            except sqlite3.IntegrityError:
+                # a constraint failed somewhere in the batch: retry row by row to isolate it
+                connection.rollback()
+                written = 0
+                for layout, rows in groups:
+                    sql, names = self._statement(*layout)
+                    for line_number, row in rows:
+                        try:
+                            cursor.execute(sql, tuple(row[name] for name in names))
+                            written += 1
+                        except sqlite3.IntegrityError as e:
+                            self._reject(line_number, str(e))
+
+            if written:
+                if unnumbered:
+                    collect_inserted(cursor, self.table_name, after_id, self.changes)
+                # per-ticket metrics are updated in the same transaction as the rows
+                mark_tables_changed(cursor, [self.table_name] + refresh_ticket_metrics(cursor, self.changes))
+            connection.commit()
+            self.stats['upserted'] += written
+            self.stats['batches'] += 1
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            
+    def _refresh_rollups(self, connection):
+        """update agent and tier metrics once per stream, since each key spans many rows"""
+        cursor = connection.cursor()
+        try:
+            changed = refresh_rollups(cursor, self.changes)
+            if changed:
+                mark_tables_changed(cursor, changed)
+            connection.commit()
+        finally:
+            cursor.close()
+            
+    def ingest(self, lines):
+        """consume an iterable of ndjson lines (str or bytes) and return ingestion stats"""
+        start_time = time.perf_counter()
+        connection = db.engine.raw_connection()
+        
+        try:
+            batch = []
+            for line_number, line in enumerate(lines, start=1):
+                if not line.strip():
+                    continue
+                self.stats['received'] += 1
+                
+                try:
+                    row, provided = self._normalize(json.loads(line))
+                except (ValueError, TypeError) as e:
+                    self._reject(line_number, str(e))
+                    continue
+                    
+                batch.append((line_number, row, provided))
+                if len(batch) >= self.batch_size:
+                    self._flush(connection, batch)
+                    batch = []
+                    
+            self._flush(connection, batch)
+        finally:
+            try:
+                self._refresh_rollups(connection)
+            finally:
+                connection.close()
+            
+        elapsed = time.perf_counter() - start_time
+        return {
+            'success': True,
+            'table': self.table_name,
+            **self.stats,
+            'elapsed_ms': int(elapsed * 1000),
+            'rows_per_second': int(self.stats['upserted'] / elapsed) if elapsed > 0 else 0
+        }
+
+def ingest_stream(table_name, lines, batch_size=5000):
+    """bulk upsert an ndjson stream into the named table"""
+    return BulkIngestor(table_name, batch_size).ingest(lines)
+
+def _open_source(path):
+    """open an ndjson file, gzip file or stdin for line iteration"""
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk upsert NDJSON records into the CX database.')
+    parser.add_argument('table', choices=list(INGEST_MODELS), help='target table')
+    parser.add_argument('path', help="ndjson file (.gz supported) or '-' for stdin")
+    parser.add_argument('--batch-size', type=int, default=None, help='rows per transaction')
+    args = parser.parse_args(argv)
+    
+    from app import create_app
+    app = create_app()
+    
+    with app.app_context():
+        source = _open_source(args.path)
+        try:
+            result = ingest_stream(args.table, source, args.batch_size or app.config['INGEST_BATCH_SIZE'])
+        finally:
+            if source is not sys.stdin.buffer:
+                source.close()
+                
+    print(json.dumps(result, indent=2))
+    return 0 if result['rejected'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
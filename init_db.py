@@ -1,5 +1,7 @@
 from datetime import datetime, timedelta
 from models import db, Customer, SupportTicket, Interaction, CustomerNote
+from ingest import INGEST_MODELS, mark_tables_changed
+from analytics import rebuild_metrics
 import random
 
 def init_database(app):
@@ -298,6 +300,15 @@ def init_database(app):
         
         db.session.commit()
         
+        # build the summary tables and stamp everything so analytical snapshots are rebuilt
+        connection = db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            mark_tables_changed(cursor, list(INGEST_MODELS) + rebuild_metrics(cursor))
+            connection.commit()
+        finally:
+            connection.close()
+        
         print("Database initialized successfully with sample data!")
         print(f"- {len(customers)} customers")
         print(f"- {len(tickets)} support tickets")
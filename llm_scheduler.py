@@ -0,0 +1,207 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from flask import current_app
+from shared_cache import get_shared_cache
+
+# lower rank is served first
+PRIORITIES = {'interactive': 0, 'summary': 1, 'batch': 2}
+
+# share of each bucket lower priorities must leave untouched, so a burst of background
+# work in one worker never spends the budget an interactive query in another worker needs
+RESERVES = {'interactive': 0.0, 'summary': 0.1, 'batch': 0.3}
+
+# longest a waiter sleeps before re-checking the shared buckets
+POLL_SECONDS = 0.1
+
+# rough characters per token, for budgeting a request before its usage is known
+CHARS_PER_TOKEN = 4
+
+# pause applied to every worker when the api answers 429 without a retry-after header
+DEFAULT_RATE_LIMIT_PAUSE = 10
+
+BUCKETS_TABLE_SQL = (
+    'CREATE TABLE IF NOT EXISTS llm_buckets ('
+    'name TEXT PRIMARY KEY, level REAL NOT NULL, updated_at REAL NOT NULL)'
+)
+
+class LLMBusyError(Exception):
+    """raised instead of waiting when the llm budget will not allow a call soon enough"""
+    
+    def __init__(self, retry_after):
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        super().__init__(f'The assistant is busy right now. Please retry in {self.retry_after} seconds.')
+
+class LLMScheduler:
+    """token-bucket admission control for llm calls, shared by every worker on the host
+    
+    two buckets (requests and tokens per minute) live in the shared cache database so all
+    worker processes spend one budget; within a process, waiters are served by priority
+    """
+    
+    def __init__(self, cache, requests_per_minute, tokens_per_minute, max_wait, queue_limit, completion_tokens):
+        self.cache = cache
+        self.rates = {'requests': requests_per_minute / 60, 'tokens': tokens_per_minute / 60}
+        self.capacity = {'requests': requests_per_minute, 'tokens': tokens_per_minute}
+        self.max_wait = max_wait
+        self.queue_limit = queue_limit
+        self.completion_tokens = completion_tokens
+        
+        self._condition = threading.Condition()
+        self._queue = []
+        self._sequence = itertools.count()
+        
+        with self.cache.transaction() as connection:
+            connection.execute(BUCKETS_TABLE_SQL)
+    
+    def estimate_tokens(self, messages):
+        """tokens a request may use: its prompt plus a typical completion"""
+        characters = sum(len(message.get('content') or '') for message in messages)
+        return characters // CHARS_PER_TOKEN + self.completion_tokens
+    
+    def _levels(self, connection, now):
+        """bucket levels refilled up to now, plus the end of any rate limit pause"""
+        rows = {
+            name: (level, updated_at)
+            for name, level, updated_at in connection.execute('SELECT name, level, updated_at FROM llm_buckets')
+        }
+        levels = {}
+        for name, rate in self.rates.items():
+            level, updated_at = rows.get(name, (self.capacity[name], now))
+            levels[name] = min(self.capacity[name], level + max(0.0, now - updated_at) * rate)
+        paused_until = rows.get('paused_until', (0.0, now))[0]
+        return levels, paused_until
+    
+    def _save(self, connection, levels, now):
+        """store bucket levels as of now"""
+        connection.executemany(
+            'INSERT OR REPLACE INTO llm_buckets (name, level, updated_at) VALUES (?, ?, ?)',
+            [(name, level, now) for name, level in levels.items()]
+        )
+    
+    def _try_acquire(self, priority, tokens):
+        """take one request and the estimated tokens; returns 0 or seconds until possible"""
+        now = time.time()
+        with self.cache.transaction() as connection:
+            levels, paused_until = self._levels(connection, now)
+            if paused_until > now:
+                return paused_until - now
+            
+            reserve = RESERVES[priority]
+            needed = {
+                'requests': 1 + reserve * self.capacity['requests'],
+                # a prompt larger than the whole bucket is admitted once the bucket is full
+                'tokens': min(tokens, self.capacity['tokens']) + reserve * self.capacity['tokens']
+            }
+            shortfall = max(
+                (needed[name] - levels[name]) / self.rates[name] for name in levels
+            )
+            if shortfall <= 0:
+                levels['requests'] -= 1
+                levels['tokens'] -= tokens
+                self._save(connection, levels, now)
+                return 0
+            return shortfall
+    
+    def _settle(self, estimated, used):
+        """correct the token bucket once the real usage of a call is known"""
+        if used is None or used == estimated:
+            return
+        now = time.time()
+        with self.cache.transaction() as connection:
+            levels, _ = self._levels(connection, now)
+            # overspending is allowed to go negative and is paid back by the refill
+            levels['tokens'] += estimated - used
+            self._save(connection, levels, now)
+    
+    def _pause(self, seconds):
+        """stop every worker from calling the api for a while"""
+        with self.cache.transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO llm_buckets (name, level, updated_at) VALUES (?, ?, ?)',
+                ('paused_until', time.time() + seconds, time.time())
+            )
+    
+    def acquire(self, priority, tokens):
+        """wait for budget in priority order, or raise LLMBusyError if it would take too long"""
+        deadline = time.monotonic() + self.max_wait[priority]
+        entry = (PRIORITIES[priority], next(self._sequence))
+        
+        with self._condition:
+            if len(self._queue) >= self.queue_limit:
+                raise LLMBusyError(len(self._queue) / self.rates['requests'])
+            heapq.heappush(self._queue, entry)
+        
+        try:
+            while True:
+                # only the highest priority waiter of this process competes for the buckets
+                with self._condition:
+                    while self._queue[0] != entry:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise LLMBusyError(len(self._queue) / self.rates['requests'])
+                        self._condition.wait(min(remaining, POLL_SECONDS))
+                
+                wait = self._try_acquire(priority, tokens)
+                if wait <= 0:
+                    return
+                # fail fast rather than hold the caller for longer than it is allowed to wait
+                if time.monotonic() + wait > deadline:
+                    raise LLMBusyError(wait)
+                time.sleep(min(wait, POLL_SECONDS))
+        finally:
+            with self._condition:
+                self._queue.remove(entry)
+                heapq.heapify(self._queue)
+                self._condition.notify_all()
+    
+    def call(self, priority, messages, request):
+        """run request() once the budget allows; request makes the actual api call"""
+        estimated = self.estimate_tokens(messages)
+        self.acquire(priority, estimated)
+        try:
+            response = request()
+        except Exception as e:
+            if getattr(e, 'status_code', None) != 429:
+                raise
+            # the shared budget was too generous (or the key is used elsewhere): back off everywhere
+            retry_after = DEFAULT_RATE_LIMIT_PAUSE
+            headers = getattr(getattr(e, 'response', None), 'headers', None) or {}
+            try:
+                retry_after = float(headers.get('retry-after', retry_after))
+            except (TypeError, ValueError):
+                pass
+            self._pause(retry_after)
+            raise LLMBusyError(retry_after)
+        
+        self._settle(estimated, getattr(getattr(response, 'usage', None), 'total_tokens', None))
+        return response
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_llm_scheduler():
+    """return the process-wide scheduler for the current app configuration, or None if disabled"""
+    config = current_app.config
+    if not config['LLM_REQUESTS_PER_MINUTE'] or not config['LLM_TOKENS_PER_MINUTE']:
+        return None
+    
+    cache = get_shared_cache()
+    key = (cache.path, config['LLM_REQUESTS_PER_MINUTE'], config['LLM_TOKENS_PER_MINUTE'])
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = LLMScheduler(
+                cache,
+                config['LLM_REQUESTS_PER_MINUTE'],
+                config['LLM_TOKENS_PER_MINUTE'],
+                max_wait={
+                    'interactive': config['LLM_MAX_WAIT_INTERACTIVE'],
+                    'summary': config['LLM_MAX_WAIT_SUMMARY'],
+                    'batch': config['LLM_MAX_WAIT_BATCH']
+                },
+                queue_limit=config['LLM_QUEUE_LIMIT'],
+                completion_tokens=config['LLM_COMPLETION_TOKENS']
+            )
+        return _schedulers[key]
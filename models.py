@@ -3,6 +3,9 @@ from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
 
+# format sqlalchemy uses for DateTime columns on sqlite, for code writing them with raw sql
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
 class Customer(db.Model):
     """customer records with account information"""
     __tablename__ = 'customers'
@@ -26,7 +29,7 @@ class SupportTicket(db.Model):
     __tablename__ = 'support_tickets'
     
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False, index=True)
     subject = db.Column(db.String(500), nullable=False)
     status = db.Column(db.String(50))  # open, in_progress, resolved, closed
     priority = db.Column(db.String(50))  # low, medium, high, urgent
@@ -44,10 +47,10 @@ class Interaction(db.Model):
     __tablename__ = 'interactions'
     
     id = db.Column(db.Integer, primary_key=True)
-    ticket_id = db.Column(db.Integer, db.ForeignKey('support_tickets.id'), nullable=False)
+    ticket_id = db.Column(db.Integer, db.ForeignKey('support_tickets.id'), nullable=False, index=True)
     interaction_type = db.Column(db.String(50))  # email, chat, phone, note
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    agent_name = db.Column(db.String(200))
+    agent_name = db.Column(db.String(200), index=True)
     duration_minutes = db.Column(db.Integer)
     
     def __repr__(self):
@@ -58,7 +61,7 @@ class CustomerNote(db.Model):
     __tablename__ = 'customer_notes'
     
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), nullable=False, index=True)
     note_text = db.Column(db.Text, nullable=False)
     created_by = db.Column(db.String(200))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -67,13 +70,66 @@ class CustomerNote(db.Model):
     def __repr__(self):
         return f'<Note {self.id}>'
 
+class TicketMetrics(db.Model):
+    """per-ticket resolution and workload metrics, maintained by analytics.py"""
+    __tablename__ = 'ticket_metrics'
+    
+    ticket_id = db.Column(db.Integer, db.ForeignKey('support_tickets.id'), primary_key=True)
+    customer_id = db.Column(db.Integer, index=True)
+    customer_tier = db.Column(db.String(50), index=True)
+    status = db.Column(db.String(50))
+    priority = db.Column(db.String(50))
+    created_at = db.Column(db.DateTime)
+    created_month = db.Column(db.String(7), index=True)  # YYYY-MM
+    resolved_at = db.Column(db.DateTime)
+    resolution_hours = db.Column(db.Float)  # null until resolved
+    interaction_count = db.Column(db.Integer)
+    total_handle_minutes = db.Column(db.Integer)
+    first_interaction_at = db.Column(db.DateTime)
+    last_interaction_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<TicketMetrics {self.ticket_id}>'
+
+class AgentMetrics(db.Model):
+    """per-agent interaction volume and handle time, maintained by analytics.py"""
+    __tablename__ = 'agent_metrics'
+    
+    agent_name = db.Column(db.String(200), primary_key=True)
+    interaction_count = db.Column(db.Integer)
+    tickets_handled = db.Column(db.Integer)
+    total_handle_minutes = db.Column(db.Integer)
+    avg_handle_minutes = db.Column(db.Float)
+    phone_count = db.Column(db.Integer)
+    chat_count = db.Column(db.Integer)
+    email_count = db.Column(db.Integer)
+    last_interaction_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<AgentMetrics {self.agent_name}>'
+
+class TierMetrics(db.Model):
+    """ticket volume and resolution time per customer tier, maintained by analytics.py"""
+    __tablename__ = 'tier_metrics'
+    
+    tier = db.Column(db.String(50), primary_key=True)
+    customer_count = db.Column(db.Integer)
+    ticket_count = db.Column(db.Integer)
+    open_ticket_count = db.Column(db.Integer)  # open or in_progress
+    resolved_ticket_count = db.Column(db.Integer)  # resolved or closed
+    tickets_per_customer = db.Column(db.Float)
+    avg_resolution_hours = db.Column(db.Float)
+    
+    def __repr__(self):
+        return f'<TierMetrics {self.tier}>'
+
 class QueryLog(db.Model):
     """comprehensive logs of all queries for analysis and debugging"""
     __tablename__ = 'query_logs'
     
     id = db.Column(db.Integer, primary_key=True)
-    session_id = db.Column(db.String(100))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    session_id = db.Column(db.String(100), index=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     user_question = db.Column(db.Text, nullable=False)
     generated_sql = db.Column(db.Text)
     result_count = db.Column(db.Integer)
@@ -90,7 +146,7 @@ class Feedback(db.Model):
     __tablename__ = 'feedback'
     
     id = db.Column(db.Integer, primary_key=True)
-    query_log_id = db.Column(db.Integer, db.ForeignKey('query_logs.id'), nullable=False)
+    query_log_id = db.Column(db.Integer, db.ForeignKey('query_logs.id'), nullable=False, index=True)
     rating = db.Column(db.String(20))  # helpful, not_helpful
     comment = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
@@ -100,3 +156,27 @@ class Feedback(db.Model):
     
     def __repr__(self):
         return f'<Feedback {self.id}: {self.rating}>'
+
+class TableVersion(db.Model):
+    """change markers for data tables, used to detect stale analytical snapshots"""
+    __tablename__ = 'table_versions'
+    
+    table_name = db.Column(db.String(100), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)  # time_ns of the last committed write
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<TableVersion {self.table_name}: {self.version}>'
+
+class QuerySummary(db.Model):
+    """llm summaries cached against query logs and the result set they describe"""
+    __tablename__ = 'query_summaries'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    query_log_id = db.Column(db.Integer, db.ForeignKey('query_logs.id'), nullable=False, index=True)
+    result_hash = db.Column(db.String(64), nullable=False, index=True)  # sha256 of question, sql and rows
+    summary = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<QuerySummary {self.id}: log {self.query_log_id}>'
@@ -1,15 +1,89 @@
+import hashlib
 import json
 import re
+import sqlite3
+import time
 from datetime import datetime
+from flask import current_app
 from openai import OpenAI
-from models import db, QueryLog
+from models import db, QueryLog, QuerySummary
+from execution import get_router, ResultSetBackend
+from shared_cache import get_shared_cache
+from llm_scheduler import LLMBusyError, get_llm_scheduler
+from sql_validator import (
+    SQLValidationError, validate_select, enforce_limit, count_query, strip_limit,
+    referenced_words, with_cte
+)
+
+# name under which a follow-up question sees the previous result set
+PREVIOUS_TABLE = 'previous'
+
+# questions that clearly refer back to the previous answer; standalone questions that merely
+# contain words like "only", "sort" or "previous" must not match, since a match swaps in the
+# compact follow-up prompt
+FOLLOW_UP_PATTERN = re.compile(
+    r"^(now|and now|what about|how about|instead|same (but|for|with)|"
+    r"(only|just) (those|these|them|the ones)|"
+    r"(sort|order|group|filter|limit|break down|split) (it|that|them|those|these|the results?)|"
+    r"break (it|that|them|those|these) down)\b"
+    r"|\b(of|from|among|in) (those|these|them)\b"
+    r"|\b(those|these) (results|rows|ones)\b"
+    r"|\b(the )?(previous|last|above|same|that|this) (result|results|answer|query|list|table)\b",
+    re.IGNORECASE
+)
+
+def is_follow_up(question):
+    """guess whether a question builds on the previous answer in the conversation"""
+    return bool(FOLLOW_UP_PATTERN.search(question.strip()))
+
+def count_matching_rows(sql):
+    """rows a query matches without its row limit, as (count, capped); (None, False) if unknown
+    
+    this re-runs the query, so callers only ask when the total is actually needed; counting
+    stops past COUNT_LIMIT rows (count is then COUNT_LIMIT and capped true) and gives up
+    after COUNT_TIMEOUT seconds
+    """
+    limit = current_app.config['COUNT_LIMIT']
+    counting_sql = count_query(sql, limit + 1)
+    if counting_sql is None:
+        return None, False
+    
+    deadline = time.monotonic() + current_app.config['COUNT_TIMEOUT']
+    connection = db.engine.raw_connection()
+    # sqlite calls the handler every few thousand instructions and aborts the query once it returns true
+    connection.driver_connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(counting_sql)
+        count = cursor.fetchone()[0]
+    except sqlite3.Error:
+        return None, False
+    finally:
+        connection.driver_connection.set_progress_handler(None, 0)
+        connection.close()
+    return min(count, limit), count > limit
 
 class QueryEngine:
     """handles natural language to sql conversion and query execution"""
     
-    def __init__(self, api_key):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key, client=None, priority='interactive'):
+        # any object with the openai chat.completions.create interface (see replay.py)
+        self.client = client if client is not None else OpenAI(api_key=api_key)
+        
+        # every api call spends the budget shared by all workers; injected clients
+        # (e.g. replay cassettes) never reach the api, so they skip it
+        self.scheduler = get_llm_scheduler() if client is None else None
+        self.priority = priority
         self.schema_info = self._get_schema_info()
+        self.base_tables = {name.upper() for name in db.metadata.tables}
+    
+    def _complete(self, priority, **request):
+        """send a chat completion, admitted by the shared llm budget"""
+        if self.scheduler is None:
+            return self.client.chat.completions.create(**request)
+        return self.scheduler.call(
+            priority, request['messages'], lambda: self.client.chat.completions.create(**request)
+        )
     
     def _get_schema_info(self):
         """get database schema information for context"""
@@ -49,14 +123,125 @@ Database Schema:
    - created_at: datetime (when note was created)
    - tags: text (comma-separated tags)
 
+Precomputed summary tables (kept up to date automatically; prefer these over re-deriving the same metrics with joins):
+
+5. ticket_metrics table (one row per support ticket):
+   - ticket_id: integer (primary key, same as support_tickets.id)
+   - customer_id: integer (foreign key to customers)
+   - customer_tier: text (tier of the ticket's customer: free, pro, or enterprise)
+   - status: text (same values as support_tickets.status)
+   - priority: text (same values as support_tickets.priority)
+   - created_at: datetime (when ticket was created)
+   - created_month: text (YYYY-MM of created_at, for monthly grouping)
+   - resolved_at: datetime (null if not resolved)
+   - resolution_hours: real (hours from creation to resolution, null if not resolved)
+   - interaction_count: integer (number of interactions on the ticket)
+   - total_handle_minutes: integer (sum of interaction durations on the ticket)
+   - first_interaction_at: datetime (null if no interactions)
+   - last_interaction_at: datetime (null if no interactions)
+
+6. agent_metrics table (one row per agent):
+   - agent_name: text (primary key, matches interactions.agent_name)
+   - interaction_count: integer (total interactions handled)
+   - tickets_handled: integer (distinct tickets the agent interacted with)
+   - total_handle_minutes: integer (sum of interaction durations)
+   - avg_handle_minutes: real (average duration of timed interactions)
+   - phone_count, chat_count, email_count: integer (interactions by type)
+   - last_interaction_at: datetime (most recent interaction)
+
+7. tier_metrics table (one row per customer tier):
+   - tier: text (primary key: free, pro, enterprise, or unknown)
+   - customer_count: integer (customers in the tier)
+   - ticket_count: integer (tickets from customers in the tier)
+   - open_ticket_count: integer (tickets open or in_progress)
+   - resolved_ticket_count: integer (tickets resolved or closed)
+   - tickets_per_customer: real (ticket_count / customer_count)
+   - avg_resolution_hours: real (average resolution_hours of resolved tickets)
+
 Important relationships:
 - customers can have multiple support_tickets
 - support_tickets can have multiple interactions
 - customers can have multiple customer_notes
+- ticket_metrics joins to support_tickets on ticket_id and to customers on customer_id
+- agent_metrics joins to interactions on agent_name
 """
     
-    def generate_sql(self, user_question, session_id):
-        """convert natural language question to sql query"""
+    def _get_compact_schema_info(self):
+        """table and column names only, for follow-ups where the previous sql carries the context"""
+        return """
+Tables (columns):
+- customers(id, name, email, company, signup_date, tier: free|pro|enterprise)
+- support_tickets(id, customer_id, subject, status: open|in_progress|resolved|closed, priority: low|medium|high|urgent, created_at, resolved_at)
+- interactions(id, ticket_id, interaction_type: email|chat|phone|note, timestamp, agent_name, duration_minutes)
+- customer_notes(id, customer_id, note_text, created_by, created_at, tags)
+- ticket_metrics(ticket_id, customer_id, customer_tier, status, priority, created_at, created_month, resolved_at, resolution_hours, interaction_count, total_handle_minutes, first_interaction_at, last_interaction_at)
+- agent_metrics(agent_name, interaction_count, tickets_handled, total_handle_minutes, avg_handle_minutes, phone_count, chat_count, email_count, last_interaction_at)
+- tier_metrics(tier, customer_count, ticket_count, open_ticket_count, resolved_ticket_count, tickets_per_customer, avg_resolution_hours)
+"""
+    
+    def _follow_up_prompt(self, conversation):
+        """system prompt for refining the previous query of a conversation"""
+        return f"""You are a SQL expert refining a previous SQLite query to answer a follow-up question.
+{self._get_compact_schema_info()}
+Previous question: {conversation['question']}
+
+Previous SQL:
+{conversation['sql']}
+
+The result of the previous SQL is available as a table named {PREVIOUS_TABLE} with columns: {', '.join(conversation['columns'])}
+
+Rules:
+1. Only generate SELECT queries (no INSERT, UPDATE, DELETE)
+2. When the question filters, sorts, groups or picks from the previous result, select FROM {PREVIOUS_TABLE}
+3. Join {PREVIOUS_TABLE} to the tables above only for columns it does not have
+4. If the question does not build on the previous result, write a new query without {PREVIOUS_TABLE}
+5. Limit results to 100 rows max
+6. Return only the SQL query, no explanation
+
+Response format:
+{{
+    "sql": "your sql query here",
+    "confidence": 0.95,
+    "reasoning": "brief explanation of query logic",
+    "tables_used": ["table1", "table2"]
+}}"""
+    
+    def _compile_follow_up(self, refinement, conversation):
+        """turn sql over the previous result into (sql for the database, plan for the cached rows)
+        
+        the database sql defines the previous result as a cte; the plan, when set, runs the
+        refinement directly on the rows kept from the previous answer
+        """
+        try:
+            refinement = validate_select(refinement)
+        except SQLValidationError as e:
+            raise ValueError(f"Generated SQL failed safety validation: {e}")
+        
+        words = referenced_words(refinement)
+        if PREVIOUS_TABLE.upper() not in words:
+            # the model answered with a standalone query
+            return self._validate_sql(refinement), None
+        
+        # a truncated previous result is recomputed in full rather than refined as shown
+        previous_sql = conversation['sql']
+        if conversation['truncated']:
+            previous_sql = strip_limit(previous_sql) or previous_sql
+        sql = self._validate_sql(with_cte(PREVIOUS_TABLE, previous_sql, refinement))
+        
+        plan = None
+        if not conversation['truncated'] and not (words & self.base_tables):
+            plan = {
+                'sql': enforce_limit(refinement, current_app.config['MAX_QUERY_RESULTS']),
+                'columns': conversation['columns'],
+                'rows': conversation['rows']
+            }
+        return sql, plan
+    
+    def generate_sql(self, user_question, session_id, conversation=None):
+        """convert natural language question to sql query
+        
+        with a conversation the question is treated as a follow-up to its previous query
+        """
         start_time = datetime.now()
         
         try:
@@ -72,7 +257,8 @@ Rules:
 4. Include relevant columns for context
 5. Limit results to 100 rows max
 6. When searching notes, use LIKE with wildcards for fuzzy matching
-7. Return only the SQL query, no explanation
+7. Use the summary tables for resolution times, interaction counts, handle times and per-tier totals
+8. Return only the SQL query, no explanation
 
 Response format:
 {{
@@ -81,8 +267,11 @@ Response format:
     "reasoning": "brief explanation of query logic",
     "tables_used": ["table1", "table2"]
 }}"""
+            if conversation is not None:
+                system_prompt = self._follow_up_prompt(conversation)
 
-            response = self.client.chat.completions.create(
+            response = self._complete(
+                self.priority,
                 model="gpt-4-turbo-preview",
                 messages=[
                     {"role": "system", "content": system_prompt},
@@ -96,9 +285,12 @@ Response format:
             sql_query = result.get('sql', '')
             confidence = result.get('confidence', 0.5)
             
-            # validate sql for safety
-            if not self._validate_sql(sql_query):
-                raise ValueError("Generated SQL failed safety validation")
+            # validate sql for safety and cap the rows it can return
+            plan = None
+            if conversation is not None:
+                sql_query, plan = self._compile_follow_up(sql_query, conversation)
+            else:
+                sql_query = self._validate_sql(sql_query)
             
             # calculate response time
             response_time = (datetime.now() - start_time).total_seconds() * 1000
@@ -121,9 +313,15 @@ Response format:
                 'confidence': confidence,
                 'reasoning': result.get('reasoning', ''),
                 'tables_used': result.get('tables_used', []),
+                'follow_up': conversation is not None,
+                'plan': plan,
                 'log_id': log_entry.id
             }
             
+        except LLMBusyError:
+            # nothing was attempted, so this is not a failed query; the caller asks for a retry
+            raise
+        
         except Exception as e:
             # log the failure
             response_time = (datetime.now() - start_time).total_seconds() * 1000
@@ -145,52 +343,55 @@ Response format:
             }
     
     def _validate_sql(self, sql):
-        """validate sql query for safety"""
-        if not sql or not isinstance(sql, str):
-            return False
-        
-        # convert to lowercase for checking
-        sql_lower = sql.lower().strip()
-        
-        # must be a select statement
-        if not sql_lower.startswith('select'):
-            return False
-        
-        # block dangerous keywords
-        dangerous_keywords = [
-            'drop', 'delete', 'insert', 'update', 'alter', 
-            'create', 'truncate', 'exec', 'execute', 'pragma'
-        ]
+        """validate sql query for safety and enforce the result row limit"""
+        try:
+            sql = validate_select(sql)
+        except SQLValidationError as e:
+            raise ValueError(f"Generated SQL failed safety validation: {e}")
+        return enforce_limit(sql, current_app.config['MAX_QUERY_RESULTS'])
+    
+    def run_sql(self, sql, plan=None):
+        """run sql and return (results as dicts, columns, engine name) without touching the log"""
+        # a follow-up over the previous result needs no trip to the database
+        columns = None
+        if plan is not None:
+            backend = ResultSetBackend(PREVIOUS_TABLE, plan['columns'], plan['rows'])
+            try:
+                columns, rows = backend.execute(plan['sql'])
+                engine_name = backend.name
+            except sqlite3.Error:
+                # e.g. duplicate column names; the cte form always works
+                columns = None
         
-        for keyword in dangerous_keywords:
-            if keyword in sql_lower:
-                return False
+        # execute query on the engine best suited to it
+        if columns is None:
+            columns, rows, engine_name = get_router().execute(sql)
         
-        # check for multiple statements (sql injection attempt)
-        if ';' in sql and not sql_lower.strip().endswith(';'):
-            return False
+        # convert to list of dicts
+        results = []
+        for row in rows:
+            row_dict = {}
+            for i, col in enumerate(columns):
+                value = row[i]
+                # convert datetime to string for json serialization
+                if isinstance(value, datetime):
+                    value = value.strftime('%Y-%m-%d %H:%M:%S')
+                row_dict[col] = value
+            results.append(row_dict)
         
-        return True
+        return results, list(columns), engine_name
     
-    def execute_query(self, sql, log_id):
-        """safely execute sql query and return results"""
+    def execute_query(self, sql, log_id, plan=None, count_total=False):
+        """safely execute sql query and return results
+        
+        only a result that hit the row limit can be missing rows; its total is None
+        (unknown) unless count_total asks for the extra count query
+        """
         try:
-            # execute query
-            result = db.session.execute(db.text(sql))
-            rows = result.fetchall()
-            columns = result.keys()
-            
-            # convert to list of dicts
-            results = []
-            for row in rows:
-                row_dict = {}
-                for i, col in enumerate(columns):
-                    value = row[i]
-                    # convert datetime to string for json serialization
-                    if isinstance(value, datetime):
-                        value = value.strftime('%Y-%m-%d %H:%M:%S')
-                    row_dict[col] = value
-                results.append(row_dict)
+            results, columns, engine_name = self.run_sql(sql, plan)
+            total_count, total_capped = len(results), False
+            if total_count >= current_app.config['MAX_QUERY_RESULTS']:
+                total_count, total_capped = count_matching_rows(sql) if count_total else (None, False)
             
             # update log with result count
             log_entry = QueryLog.query.get(log_id)
@@ -202,7 +403,11 @@ Response format:
                 'success': True,
                 'results': results,
                 'count': len(results),
-                'columns': list(columns)
+                'total_count': total_count,
+                'total_capped': total_capped,
+                'truncated': total_count is None or total_count > len(results),
+                'columns': list(columns),
+                'engine': engine_name
             }
             
         except Exception as e:
@@ -218,13 +423,12 @@ Response format:
                 'error': str(e)
             }
     
-    def summarize_results(self, user_question, sql_query, results, columns):
-        """generate human-readable summary of query results"""
-        try:
-            # prepare results summary
-            result_preview = results[:5] if len(results) > 5 else results
-            
-            prompt = f"""Summarize these query results in plain English for a business user.
+    def _request_summary(self, user_question, sql_query, results):
+        """ask the llm to summarize results; raises on api errors"""
+        # prepare results summary
+        result_preview = results[:5] if len(results) > 5 else results
+        
+        prompt = f"""Summarize these query results in plain English for a business user.
 
 User's question: {user_question}
 
@@ -241,29 +445,90 @@ Provide:
 
 Keep the summary concise and actionable. Use natural language, not technical jargon."""
 
-            response = self.client.chat.completions.create(
-                model="gpt-4-turbo-preview",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that explains data insights clearly."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.3
-            )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            # fallback to basic summary
-            if len(results) == 0:
-                return "No results found for your query."
-            else:
-                return f"Found {len(results)} results. The data includes columns: {', '.join(columns)}."
+        # summaries wait behind the questions of interactive users
+        priority = 'summary' if self.priority == 'interactive' else self.priority
+        response = self._complete(
+            priority,
+            model="gpt-4-turbo-preview",
+            messages=[
+                {"role": "system", "content": "You are a helpful assistant that explains data insights clearly."},
+                {"role": "user", "content": prompt}
+            ],
+            temperature=0.3
+        )
+        
+        return response.choices[0].message.content
+    
+    def _fallback_summary(self, results, columns):
+        """basic summary used when the llm is unavailable"""
+        if len(results) == 0:
+            return "No results found for your query."
+        else:
+            return f"Found {len(results)} results. The data includes columns: {', '.join(columns)}."
     
-    def process_query(self, user_question, session_id):
-        """complete end-to-end query processing"""
+    @staticmethod
+    def result_hash(user_question, sql_query, results):
+        """fingerprint of everything the summary depends on"""
+        payload = json.dumps(
+            [user_question.strip().lower(), sql_query, results],
+            sort_keys=True, default=str
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get_summary(self, log_id, user_question, sql_query, results, columns):
+        """return the summary for a log, reusing any summary of the same result set"""
+        cached = QuerySummary.query.filter_by(query_log_id=log_id).first()
+        if cached:
+            return cached.summary
         
-        # step 1: generate sql
-        sql_result = self.generate_sql(user_question, session_id)
+        # an identical question over identical rows gets the same summary without an llm call
+        digest = self.result_hash(user_question, sql_query, results)
+        previous = QuerySummary.query.filter_by(result_hash=digest).first()
+        if previous:
+            summary = previous.summary
+        else:
+            try:
+                summary = self._request_summary(user_question, sql_query, results)
+            except Exception:
+                # fallbacks are not cached so the next request retries the llm
+                return self._fallback_summary(results, columns)
+        
+        db.session.add(QuerySummary(query_log_id=log_id, result_hash=digest, summary=summary))
+        db.session.commit()
+        return summary
+    
+    def get_conversation(self, session_id):
+        """previous question, sql and rows of a session, if recent enough to follow up on"""
+        return get_shared_cache().get(f'conversation:{session_id}')
+    
+    def remember(self, session_id, user_question, sql, exec_result):
+        """keep the latest answer of a session so the next question can refine it"""
+        columns = exec_result['columns']
+        get_shared_cache().set(f'conversation:{session_id}', {
+            'question': user_question,
+            'sql': sql,
+            'columns': columns,
+            'rows': [[row[col] for col in columns] for row in exec_result['results']],
+            'truncated': exec_result['truncated']
+        }, ttl=current_app.config['CONVERSATION_TTL'])
+    
+    def process_query(self, user_question, session_id, defer_summary=False, follow_up=None, count_total=False):
+        """complete end-to-end query processing
+        
+        with defer_summary the response is returned as soon as the query runs and
+        the caller fetches the summary separately (see get_summary)
+        
+        follow_up=None guesses from the wording whether the question refines the session's
+        previous answer; True or False decides it explicitly
+        
+        count_total also counts every matching row when the result hits the row limit
+        """
+        
+        # step 1: generate sql, as a refinement of the previous query for follow-ups
+        conversation = None
+        if follow_up is not False and (follow_up or is_follow_up(user_question)):
+            conversation = self.get_conversation(session_id)
+        sql_result = self.generate_sql(user_question, session_id, conversation)
         
         if not sql_result['success']:
             return {
@@ -273,7 +538,9 @@ Keep the summary concise and actionable. Use natural language, not technical jar
             }
         
         # step 2: execute query
-        exec_result = self.execute_query(sql_result['sql'], sql_result['log_id'])
+        exec_result = self.execute_query(
+            sql_result['sql'], sql_result['log_id'], sql_result['plan'], count_total=count_total
+        )
         
         if not exec_result['success']:
             return {
@@ -283,22 +550,33 @@ Keep the summary concise and actionable. Use natural language, not technical jar
                 'log_id': sql_result['log_id']
             }
         
-        # step 3: summarize results
-        summary = self.summarize_results(
-            user_question,
-            sql_result['sql'],
-            exec_result['results'],
-            exec_result['columns']
-        )
+        self.remember(session_id, user_question, sql_result['sql'], exec_result)
+        
+        # step 3: summarize results, unless the caller will ask for it later
+        summary = None
+        if not defer_summary:
+            summary = self.get_summary(
+                sql_result['log_id'],
+                user_question,
+                sql_result['sql'],
+                exec_result['results'],
+                exec_result['columns']
+            )
         
         return {
             'success': True,
             'sql': sql_result['sql'],
             'results': exec_result['results'],
             'count': exec_result['count'],
+            'total_count': exec_result['total_count'],
+            'total_capped': exec_result['total_capped'],
+            'truncated': exec_result['truncated'],
             'columns': exec_result['columns'],
             'summary': summary,
+            'summary_pending': summary is None,
             'confidence': sql_result['confidence'],
             'reasoning': sql_result['reasoning'],
+            'follow_up': sql_result['follow_up'],
+            'engine': exec_result['engine'],
             'log_id': sql_result['log_id']
         }
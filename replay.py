@@ -0,0 +1,426 @@
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+# request fields that decide what the model answers
+CASSETTE_KEY_FIELDS = ('model', 'messages', 'temperature', 'response_format')
+
+# logged sql of a follow-up question, compiled over the previous answer of its session
+FOLLOW_UP_SQL_PATTERN = re.compile(r'^\s*with\s+(recursive\s+)?previous\s+as\s*\(', re.IGNORECASE)
+
+class CassetteMiss(Exception):
+    """raised in replay mode when no recorded response matches a request"""
+
+class CassetteClient:
+    """stand-in for the openai client that records or replays chat completions
+    
+    in record mode every request goes to the live client and the response is
+    appended to this process's shard in the cassette directory; in replay mode
+    responses come only from the cassettes and nothing touches the network
+    """
+    
+    def __init__(self, directory, mode='replay', live_client=None, match='request', simulate_latency=False):
+        if mode == 'record' and live_client is None:
+            raise ValueError('record mode needs a live client')
+        self.directory = directory
+        self.mode = mode
+        self.live_client = live_client
+        self.match = match
+        self.simulate_latency = simulate_latency
+        
+        # question being replayed, so cassettes can also be matched per question and call kind
+        self.question = None
+        self.stats = {'hits': 0, 'misses': 0, 'recorded': 0}
+        self.entries = {}
+        self.by_question = {}
+        self._shard = None
+        self._load()
+        
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+        
+    def _load(self):
+        """index every recorded response in the cassette directory"""
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.ndjson'))):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        self._index(json.loads(line))
+                        
+    def _index(self, entry):
+        """make an entry findable by request key and by (kind, question)"""
+        self.entries[entry['key']] = entry
+        if entry.get('question') is not None:
+            self.by_question[(entry['kind'], entry['question'])] = entry
+            
+    @staticmethod
+    def request_key(kwargs):
+        """stable fingerprint of a chat completion request"""
+        payload = {name: kwargs.get(name) for name in CASSETTE_KEY_FIELDS}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+        
+    @staticmethod
+    def request_kind(kwargs):
+        """sql generation asks for json, summaries for prose"""
+        return 'sql' if kwargs.get('response_format') else 'summary'
+        
+    @staticmethod
+    def _response(entry):
+        """rebuild the parts of an openai response object the app reads"""
+        message = types.SimpleNamespace(content=entry['content'])
+        usage = types.SimpleNamespace(**(entry.get('usage') or {}))
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)], usage=usage)
+        
+    def create(self, **kwargs):
+        """chat.completions.create"""
+        key = self.request_key(kwargs)
+        kind = self.request_kind(kwargs)
+        
+        if self.mode == 'replay':
+            entry = self.entries.get(key)
+            if entry is None and self.match == 'question':
+                entry = self.by_question.get((kind, self.question))
+            if entry is None:
+                self.stats['misses'] += 1
+                raise CassetteMiss(f'no recorded {kind} response for: {(self.question or "")[:80]}')
+            self.stats['hits'] += 1
+            if self.simulate_latency:
+                time.sleep(entry.get('elapsed_ms', 0) / 1000)
+            return self._response(entry)
+            
+        start_time = time.perf_counter()
+        response = self.live_client.chat.completions.create(**kwargs)
+        usage = getattr(response, 'usage', None)
+        entry = {
+            'key': key,
+            'kind': kind,
+            'question': self.question,
+            'model': kwargs.get('model'),
+            'content': response.choices[0].message.content,
+            'usage': {
+                name: getattr(usage, name, None)
+                for name in ('prompt_tokens', 'completion_tokens', 'total_tokens')
+            },
+            'elapsed_ms': int((time.perf_counter() - start_time) * 1000)
+        }
+        self._append(entry)
+        return response
+        
+    def _append(self, entry):
+        """write an entry to this process's shard so parallel recorders never share a file"""
+        if self._shard is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._shard = open(os.path.join(self.directory, f'shard-{os.getpid()}.ndjson'), 'a', encoding='utf-8')
+        self._shard.write(json.dumps(entry) + '\n')
+        self._shard.flush()
+        self._index(entry)
+        self.stats['recorded'] += 1
+
+def _copy_database(source_path, target_path):
+    """consistent copy of a sqlite database, safe while the source is in use"""
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def _select_logs(snapshot_path, limit=None, since=None, include_failed=False):
+    """historical questions to replay, oldest first"""
+    # each log carries the previous successful answer of its session, which follow-ups refine
+    sql = (
+        'SELECT q.id, q.session_id, q.user_question, q.generated_sql, q.success, q.result_count, '
+        'q.response_time_ms, p.user_question AS previous_question, p.generated_sql AS previous_sql '
+        'FROM query_logs q LEFT JOIN query_logs p ON p.id = ('
+        'SELECT MAX(id) FROM query_logs WHERE session_id = q.session_id AND id < q.id '
+        'AND success = 1 AND generated_sql IS NOT NULL) WHERE 1'
+    )
+    params = []
+    if not include_failed:
+        sql += ' AND q.success = 1 AND q.generated_sql IS NOT NULL'
+    if since:
+        sql += ' AND q.timestamp >= ?'
+        params.append(since)
+    sql += ' ORDER BY q.id'
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+        
+    connection = sqlite3.connect(snapshot_path)
+    connection.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in connection.execute(sql, params)]
+    finally:
+        connection.close()
+
+# per-process state set up by _init_worker
+_worker = {}
+
+def _init_worker(snapshot_path, workdir, options):
+    """give each replay process its own copy of the snapshot and its own app"""
+    pid = os.getpid()
+    database_path = os.path.join(workdir, f'worker-{pid}.db')
+    _copy_database(snapshot_path, database_path)
+    
+    # summaries cached in the snapshot would hide summarizer changes
+    connection = sqlite3.connect(database_path)
+    connection.execute('DELETE FROM query_summaries')
+    connection.commit()
+    connection.close()
+    
+    # config is read from the environment at import time, so set it before importing the app
+    os.environ['DATABASE_URL'] = f'sqlite:///{database_path}'
+    os.environ['DUCKDB_SNAPSHOT_PATH'] = os.path.join(workdir, f'worker-{pid}.duckdb')
+    if options['mode'] == 'replay':
+        # recordings share the running app's cache, where the llm budget is kept
+        os.environ['SHARED_CACHE_PATH'] = os.path.join(workdir, f'cache-{pid}.db')
+    
+    from app import create_app
+    from query_engine import QueryEngine
+    from llm_scheduler import get_llm_scheduler
+    
+    app = create_app()
+    live_client = None
+    if options['mode'] == 'record':
+        from openai import OpenAI
+        live_client = OpenAI(api_key=app.config['OPENAI_API_KEY'])
+    cassette = CassetteClient(
+        options['cassettes'], options['mode'], live_client,
+        match=options['match'], simulate_latency=options['simulate_latency']
+    )
+    
+    context = app.app_context()
+    context.push()
+    engine = QueryEngine(app.config['OPENAI_API_KEY'], client=cassette, priority='batch')
+    if options['mode'] == 'record':
+        # live calls wait behind interactive traffic instead of competing with it
+        engine.scheduler = get_llm_scheduler()
+    _worker.update(
+        context=context,
+        cassette=cassette,
+        engine=engine,
+        defer_summary=options['skip_summaries'],
+        max_results=app.config['MAX_QUERY_RESULTS']
+    )
+
+def _rows(results, columns):
+    """result dicts as comparable tuples"""
+    return [tuple(row.get(column) for column in columns) for row in results]
+
+def _diff_results(baseline_columns, baseline_rows, columns, rows):
+    """classify how a replayed result set differs from the baseline"""
+    if list(baseline_columns) != list(columns):
+        return 'different columns'
+    if baseline_rows == rows:
+        return 'identical'
+        
+    def rounded(values):
+        return [repr(tuple(round(v, 9) if isinstance(v, float) else v for v in row)) for row in values]
+    if sorted(rounded(baseline_rows)) == sorted(rounded(rows)):
+        return 'same rows, order differs'
+    return 'different rows'
+
+def _replay_one(log):
+    """replay one logged question and compare it with its baseline"""
+    engine = _worker['engine']
+    cassette = _worker['cassette']
+    misses_before = cassette.stats['misses']
+    outcome = {
+        'log_id': log['id'],
+        'question': log['user_question'],
+        'baseline_success': bool(log['success']),
+        'baseline_sql': log['generated_sql']
+    }
+    
+    # the baseline is the logged sql executed against the same snapshot
+    baseline = None
+    if log['generated_sql']:
+        start_time = time.perf_counter()
+        try:
+            results, columns, _ = engine.run_sql(log['generated_sql'])
+            baseline = (columns, _rows(results, columns))
+        except Exception as e:
+            outcome['baseline_error'] = str(e)
+        outcome['baseline_ms'] = (time.perf_counter() - start_time) * 1000
+        
+    # a follow-up is replayed against the answer it refined: the previous logged sql of its
+    # session is run on the snapshot and becomes the conversation of this replay session
+    session_id = f"replay-{log['id']}"
+    follow_up = None
+    if log['generated_sql'] and FOLLOW_UP_SQL_PATTERN.match(log['generated_sql']):
+        follow_up = True
+        if log['previous_sql']:
+            try:
+                results, columns, _ = engine.run_sql(log['previous_sql'])
+                engine.remember(session_id, log['previous_question'], log['previous_sql'], {
+                    'results': results,
+                    'columns': columns,
+                    'truncated': len(results) >= _worker['max_results']
+                })
+            except Exception as e:
+                outcome['conversation_error'] = str(e)
+    
+    cassette.question = log['user_question']
+    start_time = time.perf_counter()
+    try:
+        result = engine.process_query(
+            log['user_question'], session_id, defer_summary=_worker['defer_summary'], follow_up=follow_up
+        )
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+    outcome['pipeline_ms'] = (time.perf_counter() - start_time) * 1000
+    outcome['cassette_miss'] = cassette.stats['misses'] > misses_before
+    
+    outcome['success'] = bool(result['success'])
+    outcome['sql'] = result.get('sql')
+    outcome['error'] = result.get('error')
+    outcome['sql_changed'] = outcome['sql'] is not None and outcome['sql'] != log['generated_sql']
+    if result['success'] and baseline is not None:
+        outcome['result_diff'] = _diff_results(baseline[0], baseline[1], result['columns'], _rows(result['results'], result['columns']))
+        outcome['row_count'] = result['count']
+        outcome['baseline_row_count'] = len(baseline[1])
+    return outcome
+
+def _percentile(values, fraction):
+    """nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(outcomes, wall_seconds):
+    """aggregate replay outcomes into the regression report"""
+    total = len(outcomes)
+    pipeline = [o['pipeline_ms'] for o in outcomes]
+    baseline = [o['baseline_ms'] for o in outcomes if 'baseline_ms' in o]
+    diffs = {}
+    for o in outcomes:
+        if 'result_diff' in o:
+            diffs[o['result_diff']] = diffs.get(o['result_diff'], 0) + 1
+            
+    def timing(values):
+        if not values:
+            return None
+        return {
+            'p50_ms': round(statistics.median(values), 2),
+            'p95_ms': round(_percentile(values, 0.95), 2),
+            'max_ms': round(max(values), 2)
+        }
+        
+    return {
+        'questions': total,
+        'success_rate': round(sum(o['success'] for o in outcomes) / total, 4) if total else None,
+        'baseline_success_rate': round(sum(o['baseline_success'] for o in outcomes) / total, 4) if total else None,
+        'regressions': sum(o['baseline_success'] and not o['success'] for o in outcomes),
+        'fixed': sum(o['success'] and not o['baseline_success'] for o in outcomes),
+        'sql_changed': sum(o['sql_changed'] for o in outcomes),
+        'result_diffs': diffs,
+        'cassette_misses': sum(o['cassette_miss'] for o in outcomes),
+        'pipeline': timing(pipeline),
+        'baseline_sql': timing(baseline),
+        'wall_seconds': round(wall_seconds, 2),
+        'questions_per_second': round(total / wall_seconds, 1) if wall_seconds else None
+    }
+
+def _print_report(report, outcomes, show):
+    """human readable report: totals, then the outcomes worth looking at"""
+    print(json.dumps(report, indent=2))
+    
+    notable = [
+        o for o in outcomes
+        if (o['baseline_success'] and not o['success'])
+        or o.get('result_diff') not in (None, 'identical')
+    ]
+    for o in notable[:show]:
+        print(f"\n#{o['log_id']} {o['question']}")
+        if not o['success']:
+            print(f"  failed: {o['error']}")
+        else:
+            print(f"  result: {o.get('result_diff')} ({o.get('baseline_row_count')} -> {o.get('row_count')} rows)")
+        if o['sql_changed']:
+            print(f"  baseline sql: {o['baseline_sql']}")
+            print(f"  replayed sql: {o['sql']}")
+    if len(notable) > show:
+        print(f'\n... {len(notable) - show} more (see --output)')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay logged questions through the query pipeline with recorded LLM responses.')
+    parser.add_argument('mode', choices=['record', 'replay'],
+                        help='record calls the live api and saves cassettes; replay runs offline from them')
+    parser.add_argument('--cassettes', default=None, help='cassette directory (default instance/cassettes)')
+    parser.add_argument('--snapshot', default=None,
+                        help='sqlite database to replay against (default: a copy of DATABASE_URL)')
+    parser.add_argument('--limit', type=int, default=None, help='replay at most this many logged questions')
+    parser.add_argument('--since', default=None, help='only questions asked on or after this date (YYYY-MM-DD)')
+    parser.add_argument('--include-failed', action='store_true', help='also replay questions that failed originally')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='parallel replay processes')
+    parser.add_argument('--match', choices=['request', 'question'], default='request',
+                        help='question reuses the recorded answer for the same question even if the prompt changed')
+    parser.add_argument('--skip-summaries', action='store_true', help='stop after executing the sql')
+    parser.add_argument('--simulate-latency', action='store_true', help='sleep for each recorded response time')
+    parser.add_argument('--output', default=None, help='write every outcome as ndjson to this path')
+    parser.add_argument('--show', type=int, default=20, help='regressions and diffs to print')
+    args = parser.parse_args(argv)
+    
+    from app import create_app
+    from models import db
+    app = create_app()
+    
+    with app.app_context():
+        source_path = db.engine.url.database
+        cassettes = args.cassettes or os.path.join(app.instance_path, 'cassettes')
+        if args.mode == 'record' and not app.config['OPENAI_API_KEY']:
+            print('record mode needs OPENAI_API_KEY')
+            return 2
+            
+    workdir = tempfile.mkdtemp(prefix='apexion-replay-')
+    try:
+        snapshot_path = os.path.join(workdir, 'snapshot.db')
+        _copy_database(args.snapshot or source_path, snapshot_path)
+        logs = _select_logs(snapshot_path, args.limit, args.since, args.include_failed)
+        if not logs:
+            print('No logged questions to replay.')
+            return 0
+            
+        options = {
+            'mode': args.mode,
+            'cassettes': cassettes,
+            'match': args.match,
+            'simulate_latency': args.simulate_latency,
+            'skip_summaries': args.skip_summaries
+        }
+        processes = max(1, min(args.processes or 1, len(logs)))
+        print(f'Replaying {len(logs)} questions in {processes} processes ({args.mode} mode)...', file=sys.stderr)
+        
+        # spawn so every worker imports the app with its own database settings
+        context = multiprocessing.get_context('spawn')
+        start_time = time.perf_counter()
+        with context.Pool(processes, initializer=_init_worker, initargs=(snapshot_path, workdir, options)) as pool:
+            outcomes = list(pool.imap_unordered(_replay_one, logs, chunksize=max(1, len(logs) // (processes * 8))))
+        wall_seconds = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        
+    outcomes.sort(key=lambda o: o['log_id'])
+    report = summarize(outcomes, wall_seconds)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            for o in outcomes:
+                f.write(json.dumps(o, default=str) + '\n')
+    _print_report(report, outcomes, args.show)
+    
+    # usable as a ci gate: fail when anything that worked before stops working or changes
+    changed = sum(n for diff, n in report['result_diffs'].items() if diff != 'identical')
+    return 1 if report['regressions'] or changed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from models import db, DATETIME_FORMAT
+
+# child tables archived together with the query log they belong to
+LOG_CHILD_TABLES = {
+    'feedback': 'feedback',
+    'summaries': 'query_summaries'
+}
+
+def archive_root(app):
+    """directory holding the date-partitioned log archives"""
+    return app.config['ARCHIVE_DIR'] or os.path.join(app.instance_path, 'archive')
+
+def _rows_as_dicts(cursor):
+    """fetch the remaining rows of a cursor as column -> value dicts"""
+    names = [description[0] for description in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+def _write_partition(directory, first_id, last_id, records):
+    """write one gzip ndjson part file atomically"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'part-{first_id:012d}-{last_id:012d}.ndjson.gz')
+    tmp_path = f'{path}.tmp'
+    
+    with open(tmp_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+            for record in records:
+                f.write(json.dumps(record, default=str).encode('utf-8'))
+                f.write(b'\n')
+        raw.flush()
+        os.fsync(raw.fileno())
+        
+    # only complete files ever appear under their final name
+    os.replace(tmp_path, path)
+    return path
+
+def archive_query_logs(root, cutoff, batch_size=5000):
+    """move query logs older than cutoff (with feedback and summaries) into archive files
+    
+    each batch is written and fsynced before its rows are deleted, so a crash can
+    at worst archive a batch twice; archive queries de-duplicate by log id
+    """
+    stats = {'archived': 0, 'batches': 0, 'files': 0}
+    cutoff_text = cutoff.strftime(DATETIME_FORMAT)
+    connection = db.engine.raw_connection()
+    
+    try:
+        while True:
+            cursor = connection.cursor()
+            cursor.execute(
+                'SELECT * FROM query_logs WHERE timestamp < ? ORDER BY id LIMIT ?',
+                (cutoff_text, batch_size)
+            )
+            logs = _rows_as_dicts(cursor)
+            if not logs:
+                break
+                
+            ids = json.dumps([log['id'] for log in logs])
+            by_id = {log['id']: log for log in logs}
+            for key, table in LOG_CHILD_TABLES.items():
+                for log in logs:
+                    log[key] = []
+                cursor.execute(
+                    f'SELECT * FROM {table} WHERE query_log_id IN (SELECT value FROM json_each(?)) ORDER BY id',
+                    (ids,)
+                )
+                for child in _rows_as_dicts(cursor):
+                    by_id[child['query_log_id']][key].append(child)
+                    
+            # partition by the day the question was asked
+            partitions = {}
+            for log in logs:
+                day = (log['timestamp'] or 'unknown')[:10]
+                partitions.setdefault(day, []).append(log)
+            for day, records in partitions.items():
+                directory = os.path.join(root, 'query_logs', f'date={day}')
+                _write_partition(directory, records[0]['id'], records[-1]['id'], records)
+                stats['files'] += 1
+                
+            for table in LOG_CHILD_TABLES.values():
+                cursor.execute(f'DELETE FROM {table} WHERE query_log_id IN (SELECT value FROM json_each(?))', (ids,))
+            cursor.execute('DELETE FROM query_logs WHERE id IN (SELECT value FROM json_each(?))', (ids,))
+            connection.commit()
+            cursor.close()
+            
+            stats['archived'] += len(logs)
+            stats['batches'] += 1
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+        
+    return stats
+
+def incremental_vacuum(pages, enable=False):
+    """return freed pages to the filesystem a few at a time
+    
+    incremental vacuum needs auto_vacuum=INCREMENTAL, which an existing database only
+    picks up through one full VACUUM; that rewrite only runs when enable is set
+    """
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        mode = cursor.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode != 2:
+            if not enable:
+                return {'vacuumed_pages': 0, 'auto_vacuum': mode, 'note': 'run with --enable-incremental-vacuum once'}
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            connection.commit()
+            cursor.execute('VACUUM')
+            
+        before = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        cursor.execute(f'PRAGMA incremental_vacuum({int(pages)})')
+        cursor.fetchall()
+        connection.commit()
+        after = cursor.execute('PRAGMA freelist_count').fetchone()[0]
+        return {'vacuumed_pages': before - after, 'free_pages_left': after, 'auto_vacuum': 2}
+    finally:
+        connection.close()
+
+def _partition_days(root, since, until):
+    """archive partition directories whose day falls in [since, until)"""
+    for directory in sorted(glob.glob(os.path.join(root, 'query_logs', 'date=*'))):
+        day = os.path.basename(directory)[len('date='):]
+        if since and day < since:
+            continue
+        if until and day >= until:
+            continue
+        yield directory
+
+def query_archive(root, since=None, until=None, session_id=None, contains=None, failed_only=False):
+    """yield archived log records matching the filters, oldest first, each id once"""
+    seen = set()
+    needle = contains.lower() if contains else None
+    
+    for directory in _partition_days(root, since, until):
+        for path in sorted(glob.glob(os.path.join(directory, 'part-*.ndjson.gz'))):
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    if record['id'] in seen:
+                        continue
+                    seen.add(record['id'])
+                    
+                    if session_id and record.get('session_id') != session_id:
+                        continue
+                    if failed_only and record.get('success'):
+                        continue
+                    if needle and needle not in (record.get('user_question') or '').lower() \
+                            and needle not in (record.get('generated_sql') or '').lower():
+                        continue
+                    yield record
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query log retention and archive access.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    
+    run = subparsers.add_parser('run', help='archive logs older than the hot window and vacuum')
+    run.add_argument('--days', type=int, default=None, help='hot window in days (default LOG_RETENTION_DAYS)')
+    run.add_argument('--enable-incremental-vacuum', action='store_true',
+                     help='switch the database to incremental auto-vacuum (one full VACUUM)')
+    
+    search = subparsers.add_parser('query', help='search archived logs (prints ndjson)')
+    search.add_argument('--since', help='first day to include (YYYY-MM-DD)')
+    search.add_argument('--until', help='first day to exclude (YYYY-MM-DD)')
+    search.add_argument('--session', help='only this session id')
+    search.add_argument('--contains', help='substring of the question or generated sql')
+    search.add_argument('--failed', action='store_true', help='only failed queries')
+    search.add_argument('--limit', type=int, default=None, help='stop after this many records')
+    search.add_argument('--count', action='store_true', help='print only the number of matches')
+    
+    args = parser.parse_args(argv)
+    
+    from app import create_app
+    app = create_app()
+    root = archive_root(app)
+    
+    if args.command == 'run':
+        days = args.days if args.days is not None else app.config['LOG_RETENTION_DAYS']
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        with app.app_context():
+            start_time = time.perf_counter()
+            stats = archive_query_logs(root, cutoff, app.config['RETENTION_BATCH_SIZE'])
+            stats.update(incremental_vacuum(app.config['VACUUM_PAGES_PER_RUN'], args.enable_incremental_vacuum))
+            stats['cutoff'] = cutoff.strftime(DATETIME_FORMAT)
+            stats['elapsed_ms'] = int((time.perf_counter() - start_time) * 1000)
+        print(json.dumps(stats, indent=2))
+        return 0
+        
+    matches = query_archive(root, args.since, args.until, args.session, args.contains, args.failed)
+    count = 0
+    for record in matches:
+        count += 1
+        if not args.count:
+            print(json.dumps(record))
+        if args.limit and count >= args.limit:
+            break
+    if args.count:
+        print(count)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+import hashlib
+import json
+import os
+
+def models_fingerprint(metadata):
+    """hash of every table, column and index the models declare"""
+    parts = []
+    for table in metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend(f'{column.name} {column.type!r} {column.nullable}' for column in table.columns)
+        parts.extend(sorted(
+            f"{index.name} {','.join(column.name for column in index.columns)}" for index in table.indexes
+        ))
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+def schema_state(engine, metadata):
+    """what the startup schema check depends on, or None when it cannot be cached"""
+    database = engine.url.database
+    if engine.url.get_backend_name() != 'sqlite' or not database or database == ':memory:':
+        return None
+    if not os.path.exists(database):
+        return None
+    # sqlite bumps schema_version on every create, alter or drop in the file
+    with engine.connect() as connection:
+        version = connection.exec_driver_sql('PRAGMA schema_version').scalar()
+    return {'models': models_fingerprint(metadata), 'schema_version': version}
+
+def _load(path):
+    """cached states by database, or none if the file is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def is_current(path, database, state):
+    """true when the schema of database was already checked in exactly this state"""
+    return state is not None and _load(path).get(database) == state
+
+def remember(path, database, state):
+    """record a checked schema state; the file is replaced atomically for concurrent workers"""
+    if state is None:
+        return
+    states = _load(path)
+    states[database] = state
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    build_path = f'{path}.{os.getpid()}.tmp'
+    with open(build_path, 'w') as f:
+        json.dump(states, f, indent=2)
+    os.replace(build_path, path)
@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from flask import current_app
+
+# how often (in writes) expired entries are swept
+PURGE_EVERY = 500
+
+class SharedCache:
+    """sqlite-backed key/value store shared by every worker process on the host"""
+    
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._writes = 0
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)'
+        )
+        
+    def _connect(self):
+        """one connection per thread and process; sqlite handles cannot cross a fork"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+        
+    @staticmethod
+    def _expiry(ttl):
+        """absolute expiry timestamp for a ttl in seconds"""
+        return time.time() + ttl if ttl else None
+        
+    def get(self, key, default=None):
+        """return the value for key, or default if it is missing or expired"""
+        row = self._connect().execute(
+            'SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else default
+        
+    def set(self, key, value, ttl=None):
+        """store a json-serializable value, optionally expiring after ttl seconds"""
+        self._connect().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+            (key, json.dumps(value), self._expiry(ttl))
+        )
+        self._after_write()
+        
+    def add(self, key, value, ttl=None):
+        """store value only if key is absent or expired; returns True if this call stored it"""
+        connection = self._connect()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache WHERE key = ? AND expires_at <= ?', (key, now))
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires_at) VALUES (?, ?, ?)',
+                (key, json.dumps(value), self._expiry(ttl))
+            )
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        self._after_write()
+        return cursor.rowcount == 1
+        
+    @contextmanager
+    def transaction(self):
+        """write-locked connection for read-modify-write state kept next to the cache"""
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+    
+    def delete(self, key):
+        """remove key if present"""
+        self._connect().execute('DELETE FROM cache WHERE key = ?', (key,))
+        
+    def _after_write(self):
+        """occasionally drop expired entries so the file stays small"""
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            self._connect().execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def get_shared_cache():
+    """return the process-wide shared cache for the current app configuration"""
+    path = current_app.config['SHARED_CACHE_PATH'] or os.path.join(current_app.instance_path, 'shared_cache.db')
+    with _caches_lock:
+        if path not in _caches:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            _caches[path] = SharedCache(path)
+        return _caches[path]
@@ -0,0 +1,199 @@
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+# one pass over the sql; comments, strings and quoted identifiers are single tokens
+# so keywords inside them (or inside names like created_at) never match
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<comment>--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[A-Za-z_][A-Za-z0-9_$]*)
+  | (?P<symbol>\S)
+)""", re.VERBOSE | re.DOTALL)
+
+# statements that are allowed to start the query
+ALLOWED_FIRST_WORDS = {'SELECT', 'WITH'}
+
+# keywords that only appear in statements that change data, schema or connection state
+FORBIDDEN_KEYWORDS = {
+    'INSERT', 'UPDATE', 'DELETE', 'DROP', 'ALTER', 'CREATE', 'TRUNCATE',
+    'ATTACH', 'DETACH', 'PRAGMA', 'VACUUM', 'REINDEX', 'ANALYZE', 'EXEC', 'EXECUTE'
+}
+
+# REPLACE is also a string function, so it is only forbidden when not called
+FORBIDDEN_UNLESS_CALLED = {'REPLACE'}
+
+# functions that reach outside the database
+FORBIDDEN_FUNCTIONS = {'LOAD_EXTENSION', 'READFILE', 'WRITEFILE', 'FTS3_TOKENIZER'}
+
+Token = namedtuple('Token', 'kind value start end')
+
+# sql: the statement without comments or trailing semicolons
+# words: every bare (unquoted) keyword and name, upper-cased
+# limit: span and value of the top-level LIMIT clause (value is None when it is an expression)
+ParsedQuery = namedtuple('ParsedQuery', 'sql error words limit_start limit_value limit_value_span has_offset')
+
+class SQLValidationError(ValueError):
+    """raised when generated sql is not a single read-only SELECT"""
+
+def _tokenize(sql):
+    """split sql into significant tokens with their positions"""
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(sql):
+        kind = match.lastgroup
+        text = match.group(kind)
+        tokens.append(Token(kind, text.upper() if kind == 'word' else text, match.start(kind), match.end()))
+    return tokens
+
+def _strip_comments(sql, tokens):
+    """sql with every comment replaced by a space, re-tokenized"""
+    parts = []
+    position = 0
+    for token in tokens:
+        if token.kind == 'comment':
+            parts.append(sql[position:token.start])
+            parts.append(' ')
+            position = token.end
+    parts.append(sql[position:])
+    clean = ''.join(parts)
+    return clean, _tokenize(clean)
+
+def _error(sql, message):
+    """parse result for rejected sql"""
+    return ParsedQuery(sql, message, frozenset(), None, None, None, False)
+
+@lru_cache(maxsize=1024)
+def parse(sql):
+    """tokenize and check one statement, locating its top-level LIMIT clause"""
+    if not sql or not isinstance(sql, str):
+        return _error('', 'empty query')
+        
+    sql = sql.strip()
+    clean, tokens = sql, _tokenize(sql)
+    if any(token.kind == 'comment' for token in tokens):
+        clean, tokens = _strip_comments(sql, tokens)
+        
+    # trailing semicolons are harmless; any other one starts a second statement
+    while tokens and tokens[-1].value == ';':
+        tokens.pop()
+    if not tokens:
+        return _error('', 'empty query')
+    clean = clean[:tokens[-1].end]
+    
+    if tokens[0].kind != 'word' or tokens[0].value not in ALLOWED_FIRST_WORDS:
+        return _error(clean, 'only SELECT queries are allowed')
+        
+    depth = 0
+    limit_index = None
+    for index, token in enumerate(tokens):
+        if token.kind == 'symbol':
+            if token.value == ';':
+                return _error(clean, 'multiple statements are not allowed')
+            if token.value in ("'", '"', '`', '['):
+                return _error(clean, 'unterminated quote')
+            if token.value == '(':
+                depth += 1
+            elif token.value == ')':
+                depth -= 1
+                if depth < 0:
+                    return _error(clean, 'unbalanced parentheses')
+        elif token.kind == 'word':
+            called = index + 1 < len(tokens) and tokens[index + 1].value == '('
+            if token.value in FORBIDDEN_KEYWORDS or (token.value in FORBIDDEN_UNLESS_CALLED and not called):
+                return _error(clean, f'{token.value} is not allowed')
+            if token.value in FORBIDDEN_FUNCTIONS and called:
+                return _error(clean, f'{token.value.lower()}() is not allowed')
+            if token.value == 'LIMIT' and depth == 0:
+                limit_index = index
+    if depth != 0:
+        return _error(clean, 'unbalanced parentheses')
+        
+    words = frozenset(token.value for token in tokens if token.kind == 'word')
+    if limit_index is None:
+        return ParsedQuery(clean, None, words, None, None, None, False)
+        
+    # LIMIT n, LIMIT n OFFSET m and LIMIT m, n with literal integers are understood;
+    # anything else is treated as an expression
+    clause = tokens[limit_index + 1:]
+    values = [token.value for token in clause]
+    count_token = None
+    has_offset = False
+    if len(clause) == 1:
+        count_token = clause[0]
+    elif len(clause) == 3 and values[1] == 'OFFSET':
+        count_token, has_offset = clause[0], True
+    elif len(clause) == 3 and values[1] == ',':
+        count_token, has_offset = clause[2], True
+    else:
+        has_offset = 'OFFSET' in values or ',' in values
+        
+    limit_value = None
+    if count_token is not None and count_token.kind == 'number' and count_token.value.isdigit():
+        limit_value = int(count_token.value)
+    span = (count_token.start, count_token.end) if limit_value is not None else None
+    return ParsedQuery(clean, None, words, tokens[limit_index].start, limit_value, span, has_offset)
+
+def validate_select(sql):
+    """return sql as a single read-only statement, or raise SQLValidationError"""
+    parsed = parse(sql)
+    if parsed.error:
+        raise SQLValidationError(parsed.error)
+    return parsed.sql
+
+def enforce_limit(sql, max_rows):
+    """make sure a validated query can never return more than max_rows rows"""
+    parsed = parse(sql)
+    if parsed.error:
+        raise SQLValidationError(parsed.error)
+        
+    if parsed.limit_start is None:
+        return f'{parsed.sql} LIMIT {max_rows}'
+    if parsed.limit_value is not None:
+        if parsed.limit_value <= max_rows:
+            return parsed.sql
+        start, end = parsed.limit_value_span
+        return f'{parsed.sql[:start]}{max_rows}{parsed.sql[end:]}'
+        
+    # a computed (or negative, i.e. unlimited) limit is capped from the outside
+    return f'SELECT * FROM ({parsed.sql}) LIMIT {max_rows}'
+
+def strip_limit(sql):
+    """the query without its top-level LIMIT clause, or None if it also has an offset"""
+    parsed = parse(sql)
+    if parsed.error or parsed.has_offset:
+        return None
+    if parsed.limit_start is None:
+        return parsed.sql
+    return parsed.sql[:parsed.limit_start].rstrip()
+
+def count_query(sql, limit):
+    """sql counting the rows the query would return without its LIMIT, up to limit, or None
+    
+    recursive queries are not counted, since without their LIMIT they may never finish
+    """
+    base = strip_limit(sql)
+    if base is None or 'RECURSIVE' in parse(sql).words:
+        return None
+    return f'SELECT COUNT(*) FROM ({base} LIMIT {limit})'
+
+def referenced_words(sql):
+    """bare keywords and names used by a query (table names, columns, functions)"""
+    return parse(sql).words
+
+def with_cte(name, body, sql):
+    """prepend a common table expression to a query, merging with its own WITH clause"""
+    parsed = parse(sql)
+    if parsed.error:
+        raise SQLValidationError(parsed.error)
+    statement = parsed.sql
+    if statement[:4].upper() != 'WITH':
+        return f'WITH {name} AS ({body}) {statement}'
+        
+    rest = statement[4:].lstrip()
+    recursive = ''
+    if rest[:9].upper() == 'RECURSIVE':
+        recursive = 'RECURSIVE '
+        rest = rest[9:].lstrip()
+    return f'WITH {recursive}{name} AS ({body}), {rest}'
@@ -0,0 +1,63 @@
+"""tests for the sql safety checks and limit rewriting (run with: python -m pytest)"""
+import pytest
+from sql_validator import SQLValidationError, validate_select, enforce_limit, strip_limit, count_query
+
+@pytest.mark.parametrize('sql', [
+    'SELECT created_at, created_by FROM customer_notes',
+    'SELECT id FROM support_tickets WHERE created_at > resolved_at',
+    "SELECT REPLACE(name, 'Inc', '') FROM customers",
+    "SELECT 'DELETE FROM customers' AS example",
+    'SELECT "update" FROM customers',
+    'SELECT id FROM customers -- DROP TABLE customers',
+    'SELECT id FROM customers;',
+])
+def test_read_only_queries_are_accepted(sql):
+    assert validate_select(sql).startswith('SELECT')
+
+@pytest.mark.parametrize('sql, error', [
+    ('SELECT 1; SELECT 2', 'multiple statements'),
+    ('SELECT 1; DROP TABLE customers', 'multiple statements'),
+    ('WITH old AS (SELECT id FROM customers) DELETE FROM customers WHERE id IN old', 'DELETE'),
+    ('WITH x AS (SELECT 1) REPLACE INTO customers (id) VALUES (1)', 'REPLACE'),
+    ('DELETE FROM customers', 'only SELECT'),
+    ("SELECT load_extension('evil')", 'load_extension'),
+    ('SELECT (1', 'unbalanced parentheses'),
+    ('', 'empty query'),
+])
+def test_unsafe_queries_are_rejected(sql, error):
+    with pytest.raises(SQLValidationError, match=error):
+        validate_select(sql)
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT id FROM customers', 'SELECT id FROM customers LIMIT 100'),
+    ('SELECT id FROM customers LIMIT 10', 'SELECT id FROM customers LIMIT 10'),
+    ('SELECT id FROM customers LIMIT 500', 'SELECT id FROM customers LIMIT 100'),
+    ('SELECT id FROM customers LIMIT 20, 500', 'SELECT id FROM customers LIMIT 20, 100'),
+    ('SELECT id FROM customers LIMIT 500 OFFSET 20', 'SELECT id FROM customers LIMIT 100 OFFSET 20'),
+    ('SELECT id FROM customers LIMIT 10 * 50', 'SELECT * FROM (SELECT id FROM customers LIMIT 10 * 50) LIMIT 100'),
+    ('SELECT id FROM customers LIMIT -1', 'SELECT * FROM (SELECT id FROM customers LIMIT -1) LIMIT 100'),
+    ('SELECT id FROM (SELECT id FROM customers LIMIT 500)', 'SELECT id FROM (SELECT id FROM customers LIMIT 500) LIMIT 100'),
+])
+def test_enforce_limit_clamps_rows(sql, expected):
+    assert enforce_limit(sql, 100) == expected
+
+def test_enforce_limit_rejects_unsafe_sql():
+    with pytest.raises(SQLValidationError):
+        enforce_limit('DROP TABLE customers', 100)
+
+def test_strip_and_count_without_offset():
+    sql = 'SELECT id FROM customers ORDER BY id LIMIT 100'
+    assert strip_limit(sql) == 'SELECT id FROM customers ORDER BY id'
+    assert count_query(sql, 1001) == 'SELECT COUNT(*) FROM (SELECT id FROM customers ORDER BY id LIMIT 1001)'
+
+@pytest.mark.parametrize('sql', [
+    'SELECT id FROM customers LIMIT 100 OFFSET 20',
+    'SELECT id FROM customers LIMIT 20, 100',
+])
+def test_strip_and_count_with_offset(sql):
+    assert strip_limit(sql) is None
+    assert count_query(sql, 1001) is None
+
+def test_count_skips_recursive_queries():
+    sql = 'WITH RECURSIVE n(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM n) SELECT x FROM n LIMIT 100'
+    assert count_query(sql, 1001) is None